@@ -4,18 +4,55 @@ Define a class AE33 facilitating communication with a Magee Scientific AE33 inst
 @author: joerg.klausen@meteoswiss.ch
 """
 
+import atexit
+import json
 import logging
 import os
 import shutil
 import socket
 import re
+import select
+import threading
 import time
 import zipfile
-
-import colorama
+from concurrent.futures import ThreadPoolExecutor
 
 from mkndaq.utils import datetimebin
 
+# responses are terminated by \r\n, the \r is removed in a single pass
+_CR_TABLE = str.maketrans('', '', '\r')
+# runs of empty lines, collapsed in one pass
+_BLANK_LINES_RE = re.compile(r"\n{2,}")
+_PROMPT = b"AE33>"
+
+# console colors. On Windows, these are translated by colorama, which is initialized by mkndaq.
+_GREEN = "\x1b[32m"
+_RED = "\x1b[31m"
+_RESET = "\x1b[0m"
+
+# frequently sent commands, encoded once
+_MAXID_DATA = b"MAXID Data\r\n"
+_MINID_DATA = b"MINID Data\r\n"
+_MAXID_LOG = b"MAXID Log\r\n"
+_MINID_LOG = b"MINID Log\r\n"
+_TAPE_ADVANCES = b"$AE33:A\r\n"
+
+# maximum number of records asked for by one FETCH
+_FETCH_ROWS = 1000
+
+# positions of the items displayed in a record of the Data table
+_UVPM = 29
+_BC = 44
+
+def _tidy(resp: str) -> str:
+    """Remove carriage returns, prompts and blank lines from a response."""
+    resp = resp.translate(_CR_TABLE).replace("AE33>", "")
+    # the regex visits every line break, only use it if there is a blank line at all (rarely)
+    if "\n\n" in resp:
+        resp = _BLANK_LINES_RE.sub("\n", resp)
+    return resp
+
+
 class AE33:
     """
     Instrument of type Magee Scientific AE33 with methods, attributes for interaction.
@@ -24,23 +61,51 @@ class AE33:
     __datadir = None
     __data_begin_read_id = None
     __datafile = None
+    __data_chunks = None
+    __data_chunks_to_stage = None
+    __data_fh = None
+    __data_lock = None
     __datafile_to_stage = None
+    __day = None
+    __errors = None
     __get_config = None
+    __known_dirs = None
     __logdir = None
     __log_begin_read_id = None
+    __log_chunks = None
+    __log_chunks_to_stage = None
+    __log_fh = None
     __logfile = None
+    __log_lock = None
+    __lock = None
     __logfile_to_stage = None
     _log = None
     _logger = None
+    __minute = -1
     __name = None
+    __path_parts = None
+    __paths = None
+    __nodelay = True
+    __pipeline = False
+    __quickack = False
+    __recv_size = 65536
     __reporting_interval = None
     # __set_config = None
     __set_datetime = None
+    __sock = None
+    __sockopts = None
     __sockaddr = None
     __socksleep = None
     __socktout = None
+    __stage_executor = None
     __staging = None
+    __state_file = None
+    __state_lock = None
+    __staging_data = None
+    __staging_logs = None
     __zip = False
+    __zip_compression = zipfile.ZIP_DEFLATED
+    __zip_level = 1
 
     def __init__(self, name: str, config: dict, simulate=False) -> None:
         """
@@ -54,6 +119,12 @@ class AE33:
             - config[name]['socket']['port']
             - config[name]['socket']['timeout']
             - config[name]['socket']['sleep']
+            - config[name]['socket']['nodelay'] (optional, default True)
+            - config[name]['socket']['quickack'] (optional, default False, Linux only)
+            - config[name]['socket']['recv_buffer'] (optional, default 65536 bytes read at once)
+            - config[name]['socket']['pipeline'] (optional, default: same as quickack)
+            - config[name]['socket']['options'] (optional, list of [level, option, value], e.g.
+              [SOL_SOCKET, SO_RCVBUF, 262144], with names as defined in the socket module)
             - config[name]['get_config']
             - config[name]['set_config']
             - config[name]['get_data']
@@ -62,10 +133,10 @@ class AE33:
             - config[name]['sampling_interval']
             - config['staging']['path'])
             - config[name]['staging_zip']
+            - config[name]['staging_zip_level'] (optional, deflate level 0-9, default: 1)
+            - config[name]['staging_zip_method'] (optional, 'deflate' or 'zstd', default: 'deflate')
         :param simulate: default=True, simulate instrument behavior. Assumes a serial loopback connector.
         """
-        colorama.init(autoreset=True)
-
         try:
             self._simulate = simulate
             # setup logging
@@ -95,21 +166,61 @@ class AE33:
                              config[name]['socket']['port'])
             self.__socktout = config[name]['socket']['timeout']
             self.__socksleep = config[name]['socket']['sleep']
+            self.__nodelay = config[name]['socket'].get('nodelay', True)
+            self.__quickack = config[name]['socket'].get('quickack', False) and hasattr(socket, 'TCP_QUICKACK')
+            self.__recv_size = config[name]['socket'].get('recv_buffer', 65536)
+            # several short responses in a row can be held back by Nagle's algorithm on the instrument until
+            # we acknowledge the first, i.e., by the delayed ACK (40-200 ms). Only pipeline commands if that is
+            # known not to happen, e.g., with quickack.
+            self.__pipeline = config[name]['socket'].get('pipeline', self.__quickack)
+            # further socket options, names are resolved once
+            self.__sockopts = [tuple(getattr(socket, item) if isinstance(item, str) else item for item in option)
+                               for option in config[name]['socket'].get('options', [])]
+            # the connection is kept open and shared by all jobs of this instrument
+            self.__sock = None
+            self.__errors = {}
+            # paths of the current data and log files, by extension
+            self.__paths = {}
+            self.__lock = threading.Lock()
+            # jobs run in their own threads, a fetch still running when the next one is due makes the latter skip
+            self.__data_lock = threading.Lock()
+            self.__log_lock = threading.Lock()
+            # close the connection and flush open files when the interpreter exits
+            atexit.register(self.close)
 
             # sampling, aggregation, reporting/storage
             self._sampling_interval = config[name]['sampling_interval']
             self.__reporting_interval = config['reporting_interval']
 
             # setup data and log directory
+            # directories known to exist, these are not created again
+            self.__known_dirs = set()
             datadir = os.path.expanduser(config['data'])
             self.__datadir = os.path.join(datadir, name, "data")
-            os.makedirs(self.__datadir, exist_ok=True)
+            self._ensure_dir(self.__datadir)
             self.__logdir = os.path.join(datadir, name, "logs")
-            os.makedirs(self.__logdir, exist_ok=True)
-
-            # staging area for files to be transfered
+            self._ensure_dir(self.__logdir)
+            # fixed parts of the data and log file paths, root/yyyy/mm/dd/name-dtbin.ext, by extension
+            self.__path_parts = {ext: (os.path.join(root, ""), f"{os.sep}{name}-")
+                                 for ext, root in ((".dat", self.__datadir), (".log", self.__logdir))}
+
+            # ids of the next records to read, kept across restarts so records already saved are not fetched again
+            self.__state_file = os.path.join(self.__datadir, ".state.json")
+            self.__state_lock = threading.Lock()
+            self._load_state()
+
+            # staging area for files to be transfered, zipping is done in the background
+            self.__stage_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{name}-stage")
             self.__staging = os.path.expanduser(config['staging']['path'])
             self.__zip = config[name]['staging_zip']
+            self.__zip_level = int(config[name].get('staging_zip_level', 1))
+            if str(config[name].get('staging_zip_method', 'deflate')).lower() == 'zstd':
+                # Zstandard members in a zip require Python 3.14+, deflate is used otherwise
+                self.__zip_compression = getattr(zipfile, 'ZIP_ZSTANDARD', zipfile.ZIP_DEFLATED)
+                if self.__zip_compression == zipfile.ZIP_DEFLATED:
+                    print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} [{name}] Zstandard not supported by zipfile, using deflate.")
+            self.__staging_data = os.path.join(self.__staging, self.__name, os.path.basename(self.__datadir))
+            self.__staging_logs = os.path.join(self.__staging, self.__name, os.path.basename(self.__logdir))
 
             print(f"# Initialize AE33 (name: {self.__name}  S/N: {self.__serial_number})")
             self.get_config()
@@ -122,47 +233,289 @@ class AE33:
             print(err)
 
 
-    def tcpip_comm(self, cmd: str, tidy=True) -> str:
+    def _report(self, err: Exception, red=False) -> None:
         """
-        Send a command and retrieve the response. Assumes an open connection.
+        Log and print an error. While the instrument is unreachable, every job fails with the same few errors;
+        each of these is reported the first and then every 10th time, until communication succeeds again.
 
-        :param cmd: command sent to instrument
-        :param tidy: 
-        :return: response of instrument, decoded
+        :param err: exception caught
+        :param red: print in red, with time stamp and instrument name
+        """
+        msg = str(err)
+        count = self.__errors.get(msg, 0) + 1
+        self.__errors[msg] = count
+        if count % 10 != 1:
+            return
+        if count > 1:
+            msg = f"{msg} (repeated {count - 1} times)"
+        if self._log:
+            self._logger.error(msg)
+        if red:
+            print(f"{_RED}{time.strftime('%Y-%m-%d %H:%M:%S')} [{self.__name}] produced error {msg}.{_RESET}")
+        else:
+            print(msg)
+
+
+    def _load_state(self) -> None:
+        """
+        Restore the ids of the next Data and Log records to read, if they have been saved before. A file that
+        cannot be read or holds anything but integer ids is ignored, so all tables are read as if new.
         """
-        rcvd = b''
         try:
-            # open socket connection as a client
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM, ) as s:
+            with open(self.__state_file, "r", encoding='utf8') as fh:
+                state = json.load(fh)
+            ids = [state.get(table) for table in ('Data', 'Log')] if isinstance(state, dict) else None
+            if ids is None or any(i is not None and type(i) is not int for i in ids):
+                raise ValueError(f"{self.__state_file} ignored, no valid read ids: {state}")
+            self.__data_begin_read_id, self.__log_begin_read_id = ids
+        except FileNotFoundError:
+            pass
+        except Exception as err:
+            self._report(err)
+
+
+    def _save_state(self) -> None:
+        """
+        Save the ids of the next Data and Log records to read. The file is replaced atomically, so it is never
+        left half written.
+        """
+        with self.__state_lock:
+            tmp = f"{self.__state_file}.tmp"
+            with open(tmp, "w", encoding='utf8') as fh:
+                json.dump({'Data': self.__data_begin_read_id, 'Log': self.__log_begin_read_id}, fh)
+            os.replace(tmp, self.__state_file)
+
+
+    def _ensure_dir(self, path: str) -> None:
+        """
+        Create a directory, unless it has been created (or found to exist) before.
+
+        :param path: directory to create
+        """
+        if path not in self.__known_dirs:
+            os.makedirs(path, exist_ok=True)
+            self.__known_dirs.add(path)
+
+
+    def _get_sock(self) -> socket.socket:
+        """
+        Return the connection to the instrument, connecting if necessary. Callers must hold the lock.
+
+        :return: connected socket
+        """
+        if self.__sock is None:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, )
+            try:
+                # send commands immediately, rather than waiting for the ACK of the previous segment (Nagle)
+                if self.__nodelay:
+                    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                for level, option, value in self.__sockopts:
+                    s.setsockopt(level, option, value)
+
                 # connect to the server
                 s.settimeout(self.__socktout)
                 s.connect(self.__sockaddr)
 
-                # send data
-                s.sendall((cmd + chr(13) + chr(10)).encode())
-                time.sleep(self.__socksleep)
+                # discard the prompt sent upon connection, so it is not taken for a response. Wait for it
+                # at most socksleep seconds, rather than always sleeping that long.
+                greeting = b""
+                deadline = time.monotonic() + self.__socksleep
+                while _PROMPT not in greeting:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not select.select([s], [], [], remaining)[0]:
+                        break
+                    data = s.recv(1024)
+                    if not data:
+                        break
+                    greeting += data
+                self._drain(s)
+            except OSError:
+                s.close()
+                raise
+            self.__sock = s
+        return self.__sock
+
+
+    def _drain(self, s: socket.socket) -> None:
+        """
+        Discard any data waiting on the socket (a greeting, or the late rest of a response that timed out),
+        without blocking.
+
+        :param s: connected socket
+        :raises ConnectionResetError: if the instrument has closed the connection
+        """
+        s.setblocking(False)
+        try:
+            while True:
+                if not s.recv(4096):
+                    raise ConnectionResetError("Connection closed by instrument.")
+        except (BlockingIOError, InterruptedError):
+            pass
+        finally:
+            s.settimeout(self.__socktout)
+
+
+    def _close_sock(self) -> None:
+        """
+        Close the connection to the instrument, if any. Callers must hold the lock.
+        """
+        if self.__sock is not None:
+            try:
+                self.__sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.__sock.close()
+            self.__sock = None
+
+
+    def close(self) -> None:
+        """
+        Close the connection to the instrument and the current data and log files, and wait for files being
+        staged. All are re-opened when needed.
+        """
+        with self.__lock:
+            self._close_sock()
+        self._close_datafile()
+        self._close_logfile()
+        if self.__stage_executor is not None:
+            # wait for files being staged, jobs are run in the order submitted
+            try:
+                self.__stage_executor.submit(lambda: None).result()
+            except RuntimeError:
+                # at interpreter exit, pending jobs have already been completed by concurrent.futures
+                pass
+
+
+    def tcpip_comm(self, cmd, tidy=True, prompts=1) -> str:
+        """
+        Send a command and retrieve the response. The connection is kept open between commands and
+        re-established (once per command) if it has been dropped.
 
-                # receive response
-                while True:
+        :param cmd: command sent to instrument, either a str or bytes already terminated by \\r\\n
+        :param tidy: 
+        :param prompts: number of prompts that complete the response, i.e., number of commands sent at once
+        :return: response of instrument, decoded
+        """
+        rcvd = bytearray()
+        try:
+            msg = cmd if isinstance(cmd, bytes) else f"{cmd}\r\n".encode()
+            with self.__lock:
+                for attempt in (1, 2):
                     try:
-                        data = s.recv(1024)
-                        rcvd = rcvd + data
-                    except:
+                        s = self._get_sock()
+                        self._drain(s)
+
+                        # send data
+                        s.sendall(msg)
+
+                        # receive response, which is complete when the instrument prompts for the next command
+                        found = 0
+                        while found < prompts:
+                            try:
+                                data = s.recv(self.__recv_size)
+                            except socket.timeout:
+                                # the rest of the response may still arrive, and would be taken for the response
+                                # to the next command. Reconnect instead.
+                                self._close_sock()
+                                break
+                            if not data:
+                                if not rcvd:
+                                    # connection closed by instrument before it responded, reconnect and resend
+                                    raise ConnectionResetError("Connection closed by instrument.")
+                                # connection closed by instrument, reconnect for the next command
+                                self._close_sock()
+                                break
+                            if self.__quickack:
+                                # acknowledge immediately, the kernel falls back to delayed ACKs after each read
+                                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+                            # count prompts in the new data, including one split across two reads
+                            start = max(len(rcvd) - len(_PROMPT) + 1, 0)
+                            rcvd.extend(data)
+                            found += rcvd.count(_PROMPT, start)
                         break
+                    except OSError:
+                        self._close_sock()
+                        if attempt == 2 or rcvd:
+                            raise
+
+            if rcvd and self.__errors:
+                # the instrument responds again, report errors afresh
+                self.__errors.clear()
 
             # decode response, tidy
-            rcvd = rcvd.decode()
+            rcvd = rcvd.decode(errors="replace")
             if tidy:
                 # rcvd = rcvd.replace("\n", "").replace("\r", "").replace("AE33>", "")
-                rcvd = rcvd.replace("AE33>", "")
-                rcvd = rcvd.replace("\r\n", "\n")
-                rcvd = rcvd.replace("\n\n", "\n")
+                rcvd = _tidy(rcvd)
             return rcvd
 
         except Exception as err:
-            if self._log:
-                self._logger.error(err)
-            print(err)
+            self._report(err)
+
+
+    def tcpip_comm_batch(self, cmds: list) -> list:
+        """
+        Send several commands at once and retrieve their responses, tidied. The combined response is split
+        on the prompts that end each response. If not all commands are answered in time, or if pipelining
+        is not enabled, the commands are sent one by one.
+
+        :param cmds: commands sent to instrument, str or bytes (see tcpip_comm)
+        :return: responses of instrument, decoded, in the order of the commands
+        """
+        if not self.__pipeline:
+            return [self.tcpip_comm(cmd) for cmd in cmds]
+        if not cmds:
+            return []
+        msg = b"".join(cmd if isinstance(cmd, bytes) else f"{cmd}\r\n".encode() for cmd in cmds)
+        resp = self.tcpip_comm(msg, tidy=False, prompts=len(cmds))
+        parts = resp.split("AE33>")[:len(cmds)] if resp else []
+        if len(parts) == len(cmds):
+            return [_tidy(part) for part in parts]
+        return [self.tcpip_comm(cmd) for cmd in cmds]
+
+
+    def _current_file(self, ext: str) -> str:
+        """
+        Path of the file currently written to, root/yyyy/mm/dd/name-dtbin.ext. It is only built anew when the
+        reporting interval or the day changes.
+
+        :param ext: file extension, including the dot, '.dat' for data or '.log' for logs
+        :return: full path
+        """
+        # the bin is labelled from the same time as the key, so a path is never cached for the wrong bin
+        now = time.time()
+        key = (int(now // (self.__reporting_interval * 60)), self._day_folder())
+        cached = self.__paths.get(ext)
+        if cached is None or cached[0] != key:
+            root, sep = self.__path_parts[ext]
+            path = f"{root}{key[1]}{sep}{datetimebin.dtbin(self.__reporting_interval, t=now)}{ext}"
+            self.__paths[ext] = cached = (key, path)
+        return cached[1]
+
+
+    def _fetch_int(self, cmd) -> int:
+        """
+        Send a command answered by a single integer (e.g., MAXID, MINID) and return that integer.
+        The response is not tidied, since only its first token is needed.
+
+        :param cmd: command sent to instrument, str or bytes (see tcpip_comm)
+        :return: integer response
+        """
+        return int(self.tcpip_comm(cmd, tidy=False).split(maxsplit=1)[0])
+
+
+    def _day_folder(self) -> str:
+        """
+        Relative folder yyyy/mm/dd of the current date. It is formatted at most once per minute, since it is
+        needed by every job.
+
+        :return: relative path
+        """
+        minute = int(time.time() // 60)
+        if minute != self.__minute:
+            self.__day = time.strftime(os.path.join("%Y", "%m", "%d"))
+            self.__minute = minute
+        return self.__day
 
 
     def fetch_from_table(self, name: str, rows=None, first=None, last=None) -> str:
@@ -176,7 +529,7 @@ class AE33:
                         cmd = f"FETCH {name} 1"
                     else:
                         # fetch number of rows from end of table
-                        maxid = int(self.tcpip_comm(cmd=f"MAXID {name}", tidy=True))
+                        maxid = self._fetch_int(f"MAXID {name}")
                         cmd=f"FETCH {name} {maxid-rows}"                    
                 elif rows is None:
                     raise("Number of 'rows' to read must be provided together with 'last'.")
@@ -215,12 +568,11 @@ class AE33:
             dtm = self.tcpip_comm(cmd)
             msg = f"DateTime of instrument {self.__name} set to: {cmd}"
             print("%s %s" % (time.strftime('%Y-%m-%d %H:%M:%S'), msg))
-            self._logger.info(msg)
+            if self._log:
+                self._logger.info(msg)
 
         except Exception as err:
-            if self._log:
-                self._logger.error(err)
-            print(err)
+            self._report(err)
 
 
     def get_config(self) -> list:
@@ -233,73 +585,98 @@ class AE33:
         print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} .get_config (name={self.__name})")
         cfg = []
         try:
-            for cmd in self.__get_config:
-                cfg.append(self.tcpip_comm(cmd))
+            cfg = self.tcpip_comm_batch(self.__get_config)
 
             if self._log:
-                self._logger.info(f"Current configuration of '{self.__name}': {cfg}")
+                self._logger.info("Current configuration of '%s': %s", self.__name, cfg)
 
             return cfg
 
         except Exception as err:
-            if self._log:
-                self._logger.error(err)
-            print(err)
+            self._report(err)
 
 
-    def get_new_data(self, sep="|", save=True) -> str:
+    def _fetch_records(self, table: str, begin: int, end: int) -> tuple:
+        """
+        Fetch the records begin..end of a table, in chunks of at most _FETCH_ROWS records. A chunk only counts
+        if its response ended with the prompt. After an incomplete response, fetching stops, and the remaining
+        records are asked for again next time.
+
+        :param table: 'Data' or 'Log'
+        :param begin: id of the first record to fetch
+        :param end: id of the last record to fetch
+        :return: (records received, tidied; id of the first record not received)
+        """
+        chunks = []
+        while begin <= end:
+            last = min(begin + _FETCH_ROWS - 1, end)
+            resp = self.tcpip_comm(f"FETCH {table} {begin} {last}", tidy=False)
+            if not resp or not resp.rstrip().endswith("AE33>"):
+                self._report(TimeoutError(f"FETCH {table} {begin} {last} incomplete, will try again later"))
+                break
+            chunks.append(_tidy(resp))
+            begin = last + 1
+        return "".join(chunks), begin
+
+
+    def get_new_data(self, sep="|", save=True, maxid=None) -> str:
         """
         Retrieve all records from table data that have not been read and optionally write to log.
 
         :param str sep: item separator. Defaults to True.
         :param bln save: Should data be saved to file? Default=True
+        :param int maxid: current MAXID of the Data table, if already known. Default=None, i.e., it is queried.
         :return str response as decoded string
         """
+        if not self.__data_lock.acquire(blocking=False):
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} .get_new_data (name={self.__name}) still busy, skipped.")
+            return None
         try:
             dtm = time.strftime('%Y-%m-%d %H:%M:%S')
             print(f"{dtm} .get_new_data (name={self.__name}, save={save})")
 
             # read the latest records from the Data table
             data = ""
-            maxid = int(self.tcpip_comm(cmd="MAXID Data", tidy=True))
             # get data_begin_read_id
-            if self.__data_begin_read_id:
-                data_begin_read_id = self.__data_begin_read_id
-            else:
-                # if we don't know where to start, we start at the beginning
-                minid = int(self.tcpip_comm(cmd="MINID Data", tidy=True))
+            if self.__data_begin_read_id and maxid is None:
+                maxid = self._fetch_int(_MAXID_DATA)
+            if self.__data_begin_read_id is None or maxid is None or self.__data_begin_read_id > maxid + 1:
+                # if we don't know where to start (or the table has been reset since), we start at the beginning.
+                # Ask for both ids at once.
+                maxid, minid = (int(i) for i in self.tcpip_comm_batch([_MAXID_DATA, _MINID_DATA]))
                 # limit the number of records to download to 1440 (1 day)
                 if maxid - minid > 1440:
                     minid = maxid - 1440
                 data_begin_read_id = minid
+            else:
+                data_begin_read_id = self.__data_begin_read_id
 
             if data_begin_read_id < maxid:
-                chunk_size = 1000
-                while data_begin_read_id < maxid:
-                    if (maxid - data_begin_read_id) > chunk_size:
-                        cmd=f"FETCH Data {data_begin_read_id} {data_begin_read_id + chunk_size}"
-                    else:
-                        cmd=f"FETCH Data {data_begin_read_id} {maxid}"
-                    #print(f"                    {cmd}")
-                    data = self.tcpip_comm(cmd, tidy=True)
-                    data_begin_read_id += chunk_size + 1
-                # set data_begin_read_id
-                self.__data_begin_read_id = maxid + 1
-
-                if save:
+                # fetch the new records, the read id is only advanced past records actually received
+                data, self.__data_begin_read_id = self._fetch_records("Data", data_begin_read_id, maxid)
+                if self._log:
+                    self._logger.debug("FETCH Data %s %s: %.60s", data_begin_read_id, maxid, data)
+
+                if save and data:
                     # generate the datafile name
                     # self.__datafile = os.path.join(self.__datadir,
                     #                             "".join([self.__name, "-",
                     #                                     datetimebin.dtbin(self.__reporting_interval), ".dat"]))
-                    self.__datafile = os.path.join(self.__datadir, time.strftime("%Y"), time.strftime("%m"), time.strftime("%d"),
-                                                "".join([self.__name, "-",
-                                                        datetimebin.dtbin(self.__reporting_interval), ".dat"]))
-
-                    os.makedirs(os.path.dirname(self.__datafile), exist_ok=True)
-                    with open(self.__datafile, "at", encoding='utf8') as fh:
-                        # fh.write(f"{dtm}{sep}{data}\n")
-                        fh.write(data)
-                        fh.close()
+                    self.__datafile = self._current_file(".dat")
+
+                    # keep the datafile open until the next file is started, data is flushed after each fetch
+                    if self.__data_fh is None or self.__data_fh.name != self.__datafile:
+                        self._close_datafile()
+                        self._ensure_dir(os.path.dirname(self.__datafile))
+                        self.__data_fh = open(self.__datafile, "at", encoding='utf8', buffering=1024 * 1024)
+                        # a new file is also kept in memory, so it can be zipped without reading it back
+                        self.__data_chunks = [] if self.__zip and self.__data_fh.tell() == 0 else None
+                    # fh.write(f"{dtm}{sep}{data}\n")
+                    self.__data_fh.write(data)
+                    self.__data_fh.flush()
+                    if self.__data_chunks is not None:
+                        self.__data_chunks.append(data)
+                    self._save_state()
 
                     # stage data for transfer
                     self.stage_data_file()
@@ -307,9 +684,21 @@ class AE33:
             return data
 
         except Exception as err:
-            if self._log:
-                self._logger.error(err)
-            print(err)
+            self._report(err)
+        finally:
+            self.__data_lock.release()
+
+
+    def _close_datafile(self) -> None:
+        """
+        Close the current datafile, if open.
+        """
+        if self.__data_fh is not None:
+            if self.__data_chunks is not None:
+                self.__data_chunks_to_stage = (self.__data_fh.name, self.__data_chunks)
+                self.__data_chunks = None
+            self.__data_fh.close()
+            self.__data_fh = None
 
 
     def stage_data_file(self) -> None:
@@ -331,99 +720,141 @@ class AE33:
             if self.__datafile_to_stage is None:
                 self.__datafile_to_stage = self.__datafile
             elif self.__datafile_to_stage != self.__datafile:
-                root = os.path.join(self.__staging, self.__name, os.path.basename(self.__datadir))
-                os.makedirs(root, exist_ok=True)
-                if self.__zip:
-                    # create zip file
-                    archive = os.path.join(root, "".join([os.path.basename(self.__datafile_to_stage)[:-4], ".zip"]))
-                    with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-                        zf.write(self.__datafile_to_stage, os.path.basename(self.__datafile_to_stage))
-                else:
-                    shutil.copyfile(self.__datafile_to_stage, os.path.join(root, os.path.basename(self.__datafile_to_stage)))
+                self.__stage_executor.submit(self._stage_file, self.__datafile_to_stage, self.__staging_data, self.__data_chunks_to_stage)
                 self.__datafile_to_stage = self.__datafile
+                self.__data_chunks_to_stage = None
 
         except Exception as err:
-            if self._log:
-                self._logger.error(err)
-            print(err)
+            self._report(err)
+
+
+    def _stage_file(self, file: str, root: str, chunks=None) -> None:
+        """
+        Place a file that is no longer written to in the staging folder, zipped if staging_zip is set.
+        This runs on the staging worker thread.
+
+        :param file: file to be staged
+        :param root: staging folder
+        :param chunks: (file, list of str) with the complete content of file, if it was kept in memory, or None
+        """
+        try:
+            self._ensure_dir(root)
+            staged = self._staged_path(file, root)
+            if self.__zip:
+                # create zip file
+                with zipfile.ZipFile(staged, "w", compression=self.__zip_compression, compresslevel=self.__zip_level) as zf:
+                    if chunks and chunks[0] == file:
+                        # the file was written from start to end by this process, zip it from memory
+                        zf.writestr(os.path.basename(file), "".join(chunks[1]))
+                    else:
+                        zf.write(file, os.path.basename(file))
+            else:
+                # the file is no longer written to, so a hard link will do if staging is on the same volume
+                try:
+                    os.link(file, staged)
+                except OSError:
+                    shutil.copyfile(file, staged)
+
+        except Exception as err:
+            self._report(err)
+
+
+    def _staged_path(self, file: str, root: str) -> str:
+        """
+        Path of a file once staged in root, i.e., a .zip of the same name if staging_zip is set.
+
+        :param file: file to be staged
+        :param root: staging folder
+        :return: path of the staged file
+        """
+        name = os.path.basename(file)
+        if self.__zip:
+            name = f"{os.path.splitext(name)[0]}.zip"
+        return os.path.join(root, name)
 
 
     def print_ae33(self) -> None:
         """Retrieve current record from Data table and print."""
         try:
-            # read the last record from the Data table
-            maxid = int(self.tcpip_comm(cmd="MAXID Data", tidy=True))
-            cmd=f"FETCH Data {maxid}"                    
+            # read the last record from the Data table, asking for the remaining tape advances in the same go
+            maxid, tape_adv_remaining = self.tcpip_comm_batch([_MAXID_DATA, _TAPE_ADVANCES])
+            cmd=f"FETCH Data {int(maxid)}"                    
             data = self.tcpip_comm(cmd, tidy=True)
-            data = data.split(sep="|")
+            # split only as far as the last item displayed
+            data = data.split("|", _BC + 1)
             
-            tape_adv_remaining = self.tape_advances_remaining()
+            tape_adv_remaining = tape_adv_remaining.replace("\n", "")
             msg = f"Tape advances remaining: {tape_adv_remaining}"
             if int(tape_adv_remaining) < 10:
                 msg += " ATTENTION: Get ready to change change!"
-            print(colorama.Fore.GREEN + f"{time.strftime('%Y-%m-%d %H:%M:%S')} [{self.__name}] BC: {data[44]} ng/m3 UVPM: {data[29]} ng/m3 ({msg})")
+            print(f"{_GREEN}{time.strftime('%Y-%m-%d %H:%M:%S')} [{self.__name}] BC: {data[_BC]} ng/m3 UVPM: {data[_UVPM]} ng/m3 ({msg}){_RESET}")
 
         except Exception as err:
-            if self._log:
-                self._logger.error(err)
-            print(colorama.Fore.RED + f"{time.strftime('%Y-%m-%d %H:%M:%S')} [{self.__name}] produced error {err}.")
+            self._report(err, red=True)
 
 
     def tape_advances_remaining(self) -> str:
         try:
-            cmd = "$AE33:A"
-            res = self.tcpip_comm(cmd, tidy=True)
+            res = self.tcpip_comm(_TAPE_ADVANCES, tidy=True)
             res = res.replace("\n", "")
             return res
 
         except Exception as err:
-            if self._log:
-                self._logger.error(err)
-            print(colorama.Fore.RED + f"{time.strftime('%Y-%m-%d %H:%M:%S')} [{self.__name}] produced error {err}.")
+            self._report(err, red=True)
 
-    def get_new_log_entries(self, sep="|", save=True) -> str:
+    def get_new_log_entries(self, sep="|", save=True, maxid=None) -> str:
         """
         Retrieve all records from table data that have not been read and optionally write to log.
 
         :param str sep: item separator. Defaults to True.
         :param bln save: Should data be saved to file? Default=True
+        :param int maxid: current MAXID of the Log table, if already known. Default=None, i.e., it is queried.
         :return str response as decoded string
         """
+        if not self.__log_lock.acquire(blocking=False):
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} .get_new_log_entries (name={self.__name}) still busy, skipped.")
+            return None
         try:
             dtm = time.strftime('%Y-%m-%d %H:%M:%S')
             print(f"{dtm} .get_new_log_entries (name={self.__name}, save={save})")
 
             # get data_begin_read_id
-            if self.__log_begin_read_id:
-                log_begin_read_id = self.__log_begin_read_id
-            else:
-                # if we don't know where to start, we start at the beginning
-                minid = int(self.tcpip_comm(cmd="MINID Log", tidy=True))
-                log_begin_read_id = minid
             # read the last record from the Log table
             # get the maximum id in the Log table
+            if self.__log_begin_read_id and maxid is None:
+                maxid = self._fetch_int(_MAXID_LOG)
+            if self.__log_begin_read_id is None or maxid is None or self.__log_begin_read_id > maxid + 1:
+                # if we don't know where to start (or the table has been reset since), we start at the beginning.
+                # Ask for both ids at once.
+                minid, maxid = (int(i) for i in self.tcpip_comm_batch([_MINID_LOG, _MAXID_LOG]))
+                log_begin_read_id = minid
+            else:
+                log_begin_read_id = self.__log_begin_read_id
             log = None
-            maxid = int(self.tcpip_comm(cmd="MAXID Log", tidy=True))
             if log_begin_read_id < maxid:
-                cmd=f"FETCH Log {log_begin_read_id} {maxid}"                    
-                log = self.tcpip_comm(cmd, tidy=True)
-
-                # set log_begin_read_id for the next call
-                self.__log_begin_read_id = maxid + 1
+                # fetch the new entries, the read id is only advanced past entries actually received
+                log, self.__log_begin_read_id = self._fetch_records("Log", log_begin_read_id, maxid)
 
-                if save:
+                if save and log:
                     # generate the datafile name
                     # self.__logfile = os.path.join(self.__logdir,
                     #                             "".join([self.__name, "-",
                     #                                     datetimebin.dtbin(self.__reporting_interval), ".log"]))
-                    self.__logfile = os.path.join(self.__logdir, time.strftime("%Y"), time.strftime("%m"), time.strftime("%d"),
-                                                "".join([self.__name, "-",
-                                                        datetimebin.dtbin(self.__reporting_interval), ".log"]))
-
-                    os.makedirs(os.path.dirname(self.__logfile), exist_ok=True)
-                    with open(self.__logfile, "at", encoding='utf8') as fh:
-                        fh.write(f"{dtm}{sep}{log}\n")
-                        fh.close()
+                    self.__logfile = self._current_file(".log")
+
+                    # keep the logfile open until the next file is started, entries are flushed after each fetch
+                    if self.__log_fh is None or self.__log_fh.name != self.__logfile:
+                        self._close_logfile()
+                        self._ensure_dir(os.path.dirname(self.__logfile))
+                        self.__log_fh = open(self.__logfile, "at", encoding='utf8')
+                        # a new file is also kept in memory, so it can be zipped without reading it back
+                        self.__log_chunks = [] if self.__zip and self.__log_fh.tell() == 0 else None
+                    entry = f"{dtm}{sep}{log}\n"
+                    self.__log_fh.write(entry)
+                    self.__log_fh.flush()
+                    if self.__log_chunks is not None:
+                        self.__log_chunks.append(entry)
+                    self._save_state()
 
                     # stage data for transfer
                     self.stage_log_file()
@@ -431,9 +862,37 @@ class AE33:
             return log
 
         except Exception as err:
-            if self._log:
-                self._logger.error(err)
-            print(colorama.Fore.RED + f"{time.strftime('%Y-%m-%d %H:%M:%S')} [{self.__name}] produced error {err}.")
+            self._report(err, red=True)
+        finally:
+            self.__log_lock.release()
+
+
+    def get_new_data_and_log_entries(self, save=True) -> None:
+        """
+        Retrieve new records from both the Data and the Log table. The MAXID of both tables is asked for at once.
+
+        :param bln save: Should data be saved to file? Default=True
+        """
+        try:
+            data_maxid, log_maxid = (int(i) for i in self.tcpip_comm_batch([_MAXID_DATA, _MAXID_LOG]))
+        except Exception as err:
+            # each table asks for its own MAXID then
+            self._report(err)
+            data_maxid = log_maxid = None
+        self.get_new_data(save=save, maxid=data_maxid)
+        self.get_new_log_entries(save=save, maxid=log_maxid)
+
+
+    def _close_logfile(self) -> None:
+        """
+        Close the current logfile, if open.
+        """
+        if self.__log_fh is not None:
+            if self.__log_chunks is not None:
+                self.__log_chunks_to_stage = (self.__log_fh.name, self.__log_chunks)
+                self.__log_chunks = None
+            self.__log_fh.close()
+            self.__log_fh = None
 
 
     def stage_log_file(self) -> None:
@@ -456,21 +915,12 @@ class AE33:
             if self.__logfile_to_stage is None:
                 self.__logfile_to_stage = self.__logfile
             elif self.__logfile_to_stage != self.__logfile:
-                root = os.path.join(self.__staging, self.__name, os.path.basename(self.__logdir))
-                os.makedirs(root, exist_ok=True)
-                if self.__zip:
-                    # create zip file
-                    archive = os.path.join(root, "".join([os.path.basename(self.__logfile_to_stage)[:-4], ".zip"]))
-                    with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-                        zf.write(self.__logfile_to_stage, os.path.basename(self.__logfile_to_stage))
-                else:
-                    shutil.copyfile(self.__logfile_to_stage, os.path.join(root, os.path.basename(self.__logfile_to_stage)))
+                self.__stage_executor.submit(self._stage_file, self.__logfile_to_stage, self.__staging_logs, self.__log_chunks_to_stage)
                 self.__logfile_to_stage = self.__logfile
+                self.__log_chunks_to_stage = None
 
         except Exception as err:
-            if self._log:
-                self._logger.error(err)
-            print(err)
+            self._report(err)
 
 
     # def get_latest_ATN_info(self, save=True) -> str:
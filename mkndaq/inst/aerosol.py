@@ -9,7 +9,6 @@ import os
 import time
 import logging
 import shutil
-import zipfile
 from mkndaq.utils.filesync import rsync
 
 import colorama
@@ -135,25 +134,15 @@ class AEROSOL:
         """
         try:
             if os.path.exists(self._netshare):
-                # copy 'new' files from source to target
-                files_received = rsync(source=self._netshare, 
-                                        target=self._datadir, 
-                                        buckets=self._buckets, 
-                                        days=self._days_to_sync)
-
-                # stage data for transfer
-                for file in files_received:    
-                    stage = os.path.join(self._staging, self._name)
-                    os.makedirs(stage, exist_ok=True)
-
-                    if self._zip:
-                        # create zip file
-                        archive = os.path.join(stage, "".join([os.path.basename(file)[:-4], ".zip"]))
-                        with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as fh:
-                            fh.write(file, os.path.basename(file))
-                    else:
-                        shutil.copyfile(os.path.join(self._datadir, file), os.path.join(stage, os.path.basename(file)))
-
+                # copy 'new' files from source to target, staging them for transfer in the same pass
+                files_received = rsync(source=self._netshare,
+                                        target=self._datadir,
+                                        buckets=self._buckets,
+                                        days=self._days_to_sync,
+                                        stage=os.path.join(self._staging, self._name),
+                                        zip_files=self._zip)
+
+                for file in files_received:
                     print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} .store_and_stage_new_files (name={self._name}, file={os.path.basename(file)})")
             else:
                 msg = f"{time.strftime('%Y-%m-%d %H:%M:%S')} (name={self._name}) Warning: {self._netshare} is not accessible!)"
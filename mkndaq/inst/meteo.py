@@ -101,6 +101,10 @@ class METEO:
                 stage = os.path.join(self._staging, self._name)
                 os.makedirs(stage, exist_ok=True)
 
+                # data storage location, the same for all files of this run
+                target = os.path.join(self._datadir, time.strftime(os.path.join("%Y", "%m", "%d")))
+                os.makedirs(target, exist_ok=True)
+
                 # store and stage data files
                 for file in files:
                     # stage file
@@ -114,8 +118,6 @@ class METEO:
 
                     # move to data storage location
                     # shutil.move(os.path.join(self._source, file), os.path.join(self._datadir, file))
-                    target = os.path.join(self._datadir, time.strftime("%Y"), time.strftime("%m"), time.strftime("%d"))
-                    os.makedirs(target, exist_ok=True)
                     shutil.move(os.path.join(self._source, file), os.path.join(target, file))
 
         except Exception as err:
@@ -15,6 +15,7 @@ import colorama
 import serial
 
 from mkndaq.utils import datetimebin
+from mkndaq.utils.usbserial import set_latency_timer
 
 
 class TEI49C:
@@ -23,12 +24,14 @@ class TEI49C:
     """
 
     __datadir = None
+    __day_fmt = None
     __datafile = None
     __file_to_stage = None
     __data_header = None
     __get_config = None
     __get_data = None
     __id = None
+    __id_prefix = b''
     _log = False
     _logger = None
     __name = None
@@ -36,6 +39,7 @@ class TEI49C:
     __serial = None
     __set_config = None
     _simulate = None
+    __stage_root = None
     __staging = None
     __zip = False
 
@@ -86,6 +90,8 @@ class TEI49C:
             # read instrument control properties for later use
             self.__name = name
             self.__id = config[name]['id'] + 128
+            # the id prefix does not change, build it once
+            self.__id_prefix = b'' if self._simulate else bytes([self.__id])
             self._type = config[name]['type']
             self.__serial_number = config[name]['serial_number']
             self.__get_config = config[name]['get_config']
@@ -104,6 +110,7 @@ class TEI49C:
                                             timeout=config[port]['timeout'])
                 if self.__serial.is_open:
                     self.__serial.close()
+                set_latency_timer(port)
 
             # sampling, aggregation, reporting/storage
             # self._sampling_interval = config[name]['sampling_interval']
@@ -116,7 +123,9 @@ class TEI49C:
 
             # staging area for files to be transfered
             self.__staging = os.path.expanduser(config['staging']['path'])
+            self.__stage_root = os.path.join(self.__staging, os.path.basename(self.__datadir))
             self.__zip = config[name]['staging_zip']
+            self.__day_fmt = os.path.join("%Y", "%m", "%d")
 
             print(f"# Initialize TEI49C (name: {self.__name}  S/N: {self.__serial_number})")
             self.get_config()
@@ -128,24 +137,40 @@ class TEI49C:
             print(err)
 
 
-    def serial_comm(self, cmd: str, tidy=True) -> str:
+    def _encode(self, cmd: str) -> bytes:
+        """
+        Build the message sent to the instrument for a command, i.e., id prefix, command and <CR>.
+
+        :param cmd: command sent to instrument
+        :return: encoded message
+        """
+        return self.__id_prefix + f"{cmd}\x0D".encode()
+
+    def serial_comm(self, cmd: str, tidy=True, lines=1) -> str:
         """
         Send a command and retrieve the response. Assumes an open connection.
 
         :param cmd: command sent to instrument
         :param tidy: remove echo and checksum after '*'
+        :param lines: number of lines terminated by '\r' that complete the response (e.g., n for 'lrec i n')
         :return: response of instrument, decoded
         """
-        __id = bytes([self.__id])
-        rcvd = b''
+        rcvd = bytearray()
         try:
-            if self._simulate:
-                __id = b''
-            self.__serial.write(__id + (f"{cmd}\x0D").encode())
-            time.sleep(0.5)
-            while self.__serial.in_waiting > 0:
-                rcvd = rcvd + self.__serial.read(1024)
-                time.sleep(0.1)
+            self.__serial.write(self._encode(cmd))
+
+            # read line by line, until the expected number of lines has been received and nothing more is
+            # waiting. Allow 0.5s for the instrument to start responding, and at most 0.5s more per line.
+            start = time.monotonic_ns()
+            first_byte = start + 500_000_000
+            deadline = first_byte + lines * 500_000_000
+            while time.monotonic_ns() < deadline:
+                data = self.__serial.read_until(b'\x0D')
+                rcvd.extend(data)
+                if rcvd.endswith(b'\x0D') and rcvd.count(b'\x0D') >= lines and self.__serial.in_waiting == 0:
+                    break
+                if not rcvd and time.monotonic_ns() > first_byte:
+                    break
 
             rcvd = rcvd.decode()
             if tidy:
@@ -283,6 +308,16 @@ class TEI49C:
                 self._logger.error(err)
             print(err)
 
+    def _make_paths(self, datafile: str) -> tuple:
+        """
+        Compose the paths under which a datafile is staged for transfer.
+
+        :param datafile: full path of the datafile
+        :return: (path of the staged copy, path of the staged zip archive)
+        """
+        basename = os.path.basename(datafile)
+        return os.path.join(self.__stage_root, basename), os.path.join(self.__stage_root, f"{basename[:-4]}.zip")
+
     def get_data(self, cmd=None, save=True) -> str:
         """
         Retrieve long record from instrument and optionally write to log.
@@ -316,20 +351,17 @@ class TEI49C:
                 # self.__datafile = os.path.join(self.__datadir,
                 #                              "".join([self.__name, "-",
                 #                                       datetimebin.dtbin(self.__reporting_interval), ".dat"]))
-                self.__datafile = os.path.join(self.__datadir, time.strftime("%Y"), time.strftime("%m"), time.strftime("%d"),
+                self.__datafile = os.path.join(self.__datadir, time.strftime(self.__day_fmt),
                                              "".join([self.__name, "-",
                                                       datetimebin.dtbin(self.__reporting_interval), ".dat"]))
 
                 os.makedirs(os.path.dirname(self.__datafile), exist_ok=True)
-                if not os.path.exists(self.__datafile):
-                    # if file doesn't exist, create and write header
-                    with open(self.__datafile, "at", encoding='utf8') as fh:
-                        fh.write(f"{self.__data_header}\n")
-                        fh.close()
                 with open(self.__datafile, "at", encoding='utf8') as fh:
+                    if fh.tell() == 0:
+                        # if file is new, write header
+                        fh.write(f"{self.__data_header}\n")
                     # add data to file
                     fh.write(f"{dtm} {data}\n")
-                    fh.close()
 
                 # stage data for transfer
                 # root = os.path.join(self.__staging, os.path.basename(self.__datadir))
@@ -344,15 +376,18 @@ class TEI49C:
                 if self.__file_to_stage is None:
                     self.__file_to_stage = self.__datafile
                 elif self.__file_to_stage != self.__datafile:
-                    root = os.path.join(self.__staging, os.path.basename(self.__datadir))
-                    os.makedirs(root, exist_ok=True)
+                    os.makedirs(self.__stage_root, exist_ok=True)
+                    staged, archive = self._make_paths(self.__file_to_stage)
                     if self.__zip:
                         # create zip file
-                        archive = os.path.join(root, "".join([os.path.basename(self.__file_to_stage)[:-4], ".zip"]))
-                        with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-                            zf.write(self.__file_to_stage, os.path.basename(self.__file_to_stage))
+                        # stream the file into the archive in large chunks, keeping its timestamp
+                        zinfo = zipfile.ZipInfo.from_file(self.__file_to_stage, os.path.basename(self.__file_to_stage))
+                        zinfo.compress_type = zipfile.ZIP_DEFLATED
+                        with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf, \
+                                open(self.__file_to_stage, "rb") as src, zf.open(zinfo, "w") as dst:
+                            shutil.copyfileobj(src, dst, 1024 * 1024)
                     else:
-                        shutil.copyfile(self.__file_to_stage, os.path.join(root, os.path.basename(self.__file_to_stage)))
+                        shutil.copyfile(self.__file_to_stage, staged)
                     self.__file_to_stage = self.__datafile
 
             return data
@@ -436,38 +471,46 @@ class TEI49C:
                                             "".join([self.__name, f"_all_{CMD[i]}-",
                                                     time.strftime("%Y%m%d%H%M00"), ".dat"]))
 
-                while index > 0:
-                    if index < 10:
-                        retrieve = index
-                    cmd = f"{CMD[i]} {str(index)} {str(retrieve)}"
-                    print(cmd)
-                    self.__serial.open()
-                    data = self.serial_comm(cmd)
-                    self.__serial.close()
+                # keep the file open during the download, using a large buffer to limit write calls
+                fh = open(datafile, "at", buffering=1024 * 1024) if save else None
+                try:
+                    if save and fh.tell() == 0:
+                        # if file doesn't exist, write header
+                        fh.write(f"{self.__data_header}\n")
 
-                    if save:
-                        if not os.path.exists(datafile):
-                            # if file doesn't exist, create and write header
-                            with open(datafile, "at") as fh:
-                                fh.write(f"{self.__data_header}\n")
-                                fh.close()
-                        with open(datafile, "at") as fh:
+                    while index > 0:
+                        if index < 10:
+                            retrieve = index
+                        cmd = f"{CMD[i]} {str(index)} {str(retrieve)}"
+                        print(cmd)
+                        self.__serial.open()
+                        data = self.serial_comm(cmd, lines=retrieve)
+                        self.__serial.close()
+
+                        if save:
                             # add data to file
                             fh.write(f"{data}\n")
-                            fh.close()
 
-                    index = index - 10
+                        index = index - 10
+                finally:
+                    if fh:
+                        fh.close()
 
                 # stage data for transfer
-                root = os.path.join(self.__staging, os.path.basename(self.__datadir))
-                os.makedirs(root, exist_ok=True)
+                os.makedirs(self.__stage_root, exist_ok=True)
+                staged, archive = self._make_paths(datafile)
                 if self.__zip:
-                    # create zip file
-                    archive = os.path.join(root, "".join([os.path.basename(datafile[:-4]), ".zip"]))
-                    with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as fh:
-                        fh.write(datafile, os.path.basename(datafile))
+                    # create zip file. Dumps are far below 4 GiB, so zip64 is not needed. The archive is
+                    # synced to disk once, after it is complete.
+                    with open(archive, "wb") as fz:
+                        with zipfile.ZipFile(fz, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1,
+                                             allowZip64=False) as fh:
+                            # archive the file on disk, which also holds any records appended to it earlier
+                            fh.write(datafile, os.path.basename(datafile))
+                        fz.flush()
+                        os.fsync(fz.fileno())
                 else:
-                    shutil.copyfile(datafile, os.path.join(root, os.path.basename(datafile)))
+                    shutil.copyfile(datafile, staged)
 
             return 0
 
@@ -17,6 +17,7 @@ import zipfile
 import colorama
 
 from mkndaq.utils import datetimebin
+from mkndaq.utils.usbserial import set_latency_timer
 
 
 class TEI49I:
@@ -25,12 +26,14 @@ class TEI49I:
     """
 
     __datadir = None
+    __day_fmt = None
     __datafile = ""
     __file_to_stage = None
     __data_header = None
     __get_config = None
     __get_data = None
     __id = None
+    __id_prefix = b''
     _log = None
     _logger = None
     __name = None
@@ -41,6 +44,7 @@ class TEI49I:
     __sockaddr = None
     __socksleep = None
     __socktout = None
+    __stage_root = None
     __staging = None
     __zip = False
 
@@ -91,6 +95,8 @@ class TEI49I:
             # read instrument control properties for later use
             self.__name = name
             self.__id = config[name]['id'] + 128
+            # the id prefix does not change, build it once
+            self.__id_prefix = b'' if self._simulate else bytes([self.__id])
             self._type = config[name]['type']
             self.__serial_number = config[name]['serial_number']
             self.__get_config = config[name]['get_config']
@@ -110,6 +116,7 @@ class TEI49I:
                 # print(port)
                 if self.__serial.is_open:
                     self.__serial.close()
+                set_latency_timer(port)
                 print(f"Serial port {port} successfully opened and closed.")
             else:
                 # configure tcp/ip
@@ -129,7 +136,9 @@ class TEI49I:
 
             # staging area for files to be transfered
             self.__staging = os.path.expanduser(config['staging']['path'])
+            self.__stage_root = os.path.join(self.__staging, os.path.basename(self.__datadir))
             self.__zip = config[name]['staging_zip']
+            self.__day_fmt = os.path.join("%Y", "%m", "%d")
 
             print(f"# Initialize TEI49I (name: {self.__name}  S/N: {self.__serial_number})")
             self.get_config()
@@ -141,6 +150,15 @@ class TEI49I:
             print(err)
 
 
+    def _encode(self, cmd: str) -> bytes:
+        """
+        Build the message sent to the instrument for a command, i.e., id prefix, command and <CR>.
+
+        :param cmd: command sent to instrument
+        :return: encoded message
+        """
+        return self.__id_prefix + f"{cmd}\x0D".encode()
+
     def tcpip_comm(self, cmd: str, tidy=True) -> str:
         """
         Send a command and retrieve the response. Assumes an open connection.
@@ -149,7 +167,6 @@ class TEI49I:
         :param tidy: remove cmd echo, \n and *\r\x00 from result string, terminate with \n
         :return: response of instrument, decoded
         """
-        __id = bytes([self.__id])
         rcvd = b''
         try:
             # open socket connection as a client
@@ -161,11 +178,8 @@ class TEI49I:
                     s.settimeout(self.__socktout)
                     s.connect(self.__sockaddr)
 
-                    if self._simulate:
-                        __id = b''
-
                     # send data
-                    s.sendall(__id + (f"{cmd}\x0D").encode())
+                    s.sendall(self._encode(cmd))
                     time.sleep(self.__socksleep)
 
                     # receive response
@@ -197,24 +211,31 @@ class TEI49I:
             print(err)
 
 
-    def serial_comm(self, cmd: str, tidy=True) -> str:
+    def serial_comm(self, cmd: str, tidy=True, lines=1) -> str:
         """
         Send a command and retrieve the response. Assumes an open connection.
 
         :param cmd: command sent to instrument
         :param tidy: remove echo and checksum after '*'
+        :param lines: number of lines terminated by '\r' that complete the response (e.g., n for 'lrec i n')
         :return: response of instrument, decoded
         """
-        __id = bytes([self.__id])
-        rcvd = b''
+        rcvd = bytearray()
         try:
-            if self._simulate:
-                __id = b''
-            self.__serial.write(__id + (f"{cmd}\x0D").encode())
-            time.sleep(0.5)
-            while self.__serial.in_waiting > 0:
-                rcvd = rcvd + self.__serial.read(1024)
-                time.sleep(0.1)
+            self.__serial.write(self._encode(cmd))
+
+            # read line by line, until the expected number of lines has been received and nothing more is
+            # waiting. Allow 0.5s for the instrument to start responding, and at most 0.5s more per line.
+            start = time.monotonic_ns()
+            first_byte = start + 500_000_000
+            deadline = first_byte + lines * 500_000_000
+            while time.monotonic_ns() < deadline:
+                data = self.__serial.read_until(b'\x0D')
+                rcvd.extend(data)
+                if rcvd.endswith(b'\x0D') and rcvd.count(b'\x0D') >= lines and self.__serial.in_waiting == 0:
+                    break
+                if not rcvd and time.monotonic_ns() > first_byte:
+                    break
 
             rcvd = rcvd.decode()
             if tidy:
@@ -320,6 +341,16 @@ class TEI49I:
             print(err)
 
 
+    def _make_paths(self, datafile: str) -> tuple:
+        """
+        Compose the paths under which a datafile is staged for transfer.
+
+        :param datafile: full path of the datafile
+        :return: (path of the staged copy, path of the staged zip archive)
+        """
+        basename = os.path.basename(datafile)
+        return os.path.join(self.__stage_root, basename), os.path.join(self.__stage_root, f"{basename[:-4]}.zip")
+
     def get_data(self, cmd=None, save=True) -> str:
         """
         Send command, retrieve response from instrument and optionally write to log.
@@ -351,20 +382,18 @@ class TEI49I:
                 # self.__datafile = os.path.join(self.__datadir, 
                 #                              "".join([self.__name, "-",
                 #                                       datetimebin.dtbin(self._reporting_interval), ".dat"]))
-                self.__datafile = os.path.join(self.__datadir, time.strftime("%Y"), time.strftime("%m"), time.strftime("%d"),
+                self.__datafile = os.path.join(self.__datadir, time.strftime(self.__day_fmt),
                                              "".join([self.__name, "-",
                                                       datetimebin.dtbin(self._reporting_interval), ".dat"]))
 
                 os.makedirs(os.path.dirname(self.__datafile), exist_ok=True)
 
-                if not os.path.exists(self.__datafile):
-                    # if file doesn't exist, create and write header
-                    with open(self.__datafile, "at", encoding='utf8') as fh:
-                        fh.write(f"{self.__data_header}\n")
-                        fh.close()
                 with open(self.__datafile, "at", encoding='utf8') as fh:
+                    if fh.tell() == 0:
+                        # if file is new, write header
+                        fh.write(f"{self.__data_header}\n")
+                    # add data to file
                     fh.write(f"{dtm} {data}\n")
-                    fh.close()
 
                 # stage data for transfer
                 # root = os.path.join(self.__staging, os.path.basename(self.__datadir))
@@ -379,15 +408,18 @@ class TEI49I:
                 if self.__file_to_stage is None:
                     self.__file_to_stage = self.__datafile
                 elif self.__file_to_stage != self.__datafile:
-                    root = os.path.join(self.__staging, os.path.basename(self.__datadir))
-                    os.makedirs(root, exist_ok=True)
+                    os.makedirs(self.__stage_root, exist_ok=True)
+                    staged, archive = self._make_paths(self.__file_to_stage)
                     if self.__zip:
                         # create zip file
-                        archive = os.path.join(root, "".join([os.path.basename(self.__file_to_stage)[:-4], ".zip"]))
-                        with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-                            zf.write(self.__file_to_stage, os.path.basename(self.__file_to_stage))
+                        # stream the file into the archive in large chunks, keeping its timestamp
+                        zinfo = zipfile.ZipInfo.from_file(self.__file_to_stage, os.path.basename(self.__file_to_stage))
+                        zinfo.compress_type = zipfile.ZIP_DEFLATED
+                        with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf, \
+                                open(self.__file_to_stage, "rb") as src, zf.open(zinfo, "w") as dst:
+                            shutil.copyfileobj(src, dst, 1024 * 1024)
                     else:
-                        shutil.copyfile(self.__file_to_stage, os.path.join(root, os.path.basename(self.__file_to_stage)))
+                        shutil.copyfile(self.__file_to_stage, staged)
                     self.__file_to_stage = self.__datafile
 
             return data
@@ -425,54 +457,61 @@ class TEI49I:
             index = no_of_lrec
             retrieve = 10
 
-            while index > 0:
-                if index < 10:
-                    retrieve = index
-                cmd = f"lrec {str(index)} {str(retrieve)}"
-                print(cmd)
-                if self._serial_com:
-                    data = self.serial_comm(cmd)
-                else:
-                    data = self.tcpip_comm(cmd)
-
-                # remove all the extra info in the string returned
-                # 05:26 07-19-22 flags 0C100400 o3 30.781 hio3 0.000 cellai 50927 cellbi 51732 bncht 29.9 lmpt 53.1 o3lt 0.0 flowa 0.435 flowb 0.000 pres 493.7
-                data = data.replace("flags ", "")
-                data = data.replace("hio3 ", "")
-                data = data.replace("cellai ", "")
-                data = data.replace("cellbi ", "")
-                data = data.replace("bncht ", "")
-                data = data.replace("lmpt ", "")
-                data = data.replace("o3lt ", "")
-                data = data.replace("flowa ", "")
-                data = data.replace("flowb ", "")
-                data = data.replace("pres ", "")
-                data = data.replace("o3 ", "")
-
-                if save:
-                    if not os.path.exists(self.__datafile):
-                        # if file doesn't exist, create and write header
-                        with open(self.__datafile, "at", encoding='utf8') as fh:
-                            fh.write(f"{self.__data_header}\n")
-                            fh.close()
-
-                    with open(self.__datafile, "at", encoding='utf8') as fh:
+            # keep the file open during the download, using a large buffer to limit write calls
+            fh = open(self.__datafile, "at", encoding='utf8', buffering=1024 * 1024) if save else None
+            try:
+                if save and fh.tell() == 0:
+                    # if file doesn't exist, write header
+                    fh.write(f"{self.__data_header}\n")
+
+                while index > 0:
+                    if index < 10:
+                        retrieve = index
+                    cmd = f"lrec {str(index)} {str(retrieve)}"
+                    print(cmd)
+                    if self._serial_com:
+                        data = self.serial_comm(cmd, lines=retrieve)
+                    else:
+                        data = self.tcpip_comm(cmd)
+
+                    # remove all the extra info in the string returned
+                    # 05:26 07-19-22 flags 0C100400 o3 30.781 hio3 0.000 cellai 50927 cellbi 51732 bncht 29.9 lmpt 53.1 o3lt 0.0 flowa 0.435 flowb 0.000 pres 493.7
+                    data = data.replace("flags ", "")
+                    data = data.replace("hio3 ", "")
+                    data = data.replace("cellai ", "")
+                    data = data.replace("cellbi ", "")
+                    data = data.replace("bncht ", "")
+                    data = data.replace("lmpt ", "")
+                    data = data.replace("o3lt ", "")
+                    data = data.replace("flowa ", "")
+                    data = data.replace("flowb ", "")
+                    data = data.replace("pres ", "")
+                    data = data.replace("o3 ", "")
+
+                    if save:
                         fh.write(f"{data}\n")
-                        fh.close()
 
-                index = index - 10
+                    index = index - 10
+            finally:
+                if fh:
+                    fh.close()
 
             if save:
                 # stage data for transfer
-                root = os.path.join(self.__staging, os.path.basename(self.__datadir))
-                os.makedirs(root, exist_ok=True)
+                os.makedirs(self.__stage_root, exist_ok=True)
+                staged, archive = self._make_paths(self.__datafile)
                 if self.__zip:
-                    # create zip file
-                    archive = os.path.join(root, "".join([os.path.basename(self.__datafile[:-4]), ".zip"]))
-                    with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as fh:
-                        fh.write(self.__datafile, os.path.basename(self.__datafile))
+                    # create zip file. Dumps are far below 4 GiB, so zip64 is not needed. The archive is
+                    # synced to disk once, after it is complete.
+                    with open(archive, "wb") as fz:
+                        with zipfile.ZipFile(fz, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1,
+                                             allowZip64=False) as fh:
+                            # archive the file on disk, which also holds any records appended to it earlier
+                            fh.write(self.__datafile, os.path.basename(self.__datafile))
+                        fz.flush()
+                        os.fsync(fz.fileno())
                 else:
-                    shutil.copyfile(self.__datafile, os.path.join(root, os.path.basename(self.__datafile)))
+                    shutil.copyfile(self.__datafile, staged)
 
             return data
 
@@ -16,7 +16,6 @@ import schedule
 import colorama
 
 from mkndaq.utils.configparser import config
-from mkndaq.utils.filetransfer import SFTPClient
 
 def run_threaded(job_func):
     """Set up threading and start job.
@@ -78,6 +77,7 @@ def main():
     try:
         # initialize data transfer, set up remote folders
         if cfg.get('sftp', None):
+            from mkndaq.utils.filetransfer import SFTPClient
             sftp = SFTPClient(config=cfg)
             sftp.setup_remote_folders()
 
@@ -133,8 +133,7 @@ def main():
             if cfg.get('ae33', None):
                 from mkndaq.inst.ae33 import AE33
                 ae33 = AE33(name='ae33', config=cfg)
-                schedule.every(cfg['ae33']['sampling_interval']).minutes.at(':00').do(ae33.get_new_data)
-                schedule.every(cfg['ae33']['sampling_interval']).minutes.at(':00').do(ae33.get_new_log_entries)
+                schedule.every(cfg['ae33']['sampling_interval']).minutes.at(':00').do(run_threaded, ae33.get_new_data_and_log_entries)
                 schedule.every(fetch).seconds.do(run_threaded, ae33.print_ae33)
 
         except Exception as err:
@@ -160,7 +159,9 @@ def main():
 
         while True:
             schedule.run_pending()
-            time.sleep(1)
+            # sleep until the next job is due, rather than polling every second (max. 60 s)
+            idle = schedule.idle_seconds()
+            time.sleep(min(max(idle, 0.01), 60) if idle is not None else 1)
 
     except Exception as err:
         if logs:
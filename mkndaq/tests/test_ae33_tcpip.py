@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the AE33 driver, against a local server mimicking the instrument's TCP/IP interface.
+"""
+
+import glob
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from mkndaq.inst.ae33 import AE33
+
+
+def ae33_server(srv, tables, close_after_reply=False, stalls=None):
+    """
+    Mimick an AE33: prompt upon connection, answer MAXID, MINID and FETCH for the Data and Log tables.
+    Each connection is served in its own thread.
+
+    :param srv: listening socket
+    :param tables: dict {table: maxid}, the records of each table have ids 1..maxid
+    :param close_after_reply: close the connection after each reply, like an instrument dropping idle clients
+    :param stalls: list with the number of FETCH responses to interrupt halfway for longer than the client's timeout
+    """
+    while True:
+        try:
+            conn, _ = srv.accept()
+        except OSError:
+            return
+        threading.Thread(target=_serve, args=(conn, tables, close_after_reply, stalls), daemon=True).start()
+
+
+def _serve(conn, tables, close_after_reply, stalls):
+    with conn:
+        conn.sendall(b"AE33>")
+        buf = b""
+        while True:
+            try:
+                data = conn.recv(1024)
+            except OSError:
+                break
+            if not data:
+                break
+            buf += data
+            while b"\r\n" in buf:
+                line, buf = buf.split(b"\r\n", 1)
+                cmd = line.decode().split()
+                if cmd[0] == "MAXID":
+                    resp = f"{tables[cmd[1]]}\r\n"
+                elif cmd[0] == "MINID":
+                    resp = "1\r\n"
+                elif cmd[0] == "FETCH":
+                    lo = int(cmd[2])
+                    hi = int(cmd[3]) if len(cmd) > 3 else lo
+                    resp = "".join(f"{cmd[1]} {i}|x\r\n" for i in range(lo, hi + 1))
+                    if stalls and stalls[0] > 0:
+                        stalls[0] -= 1
+                        half = len(resp) // 2
+                        conn.sendall(resp[:half].encode())
+                        time.sleep(1.5)
+                        resp = resp[half:]
+                else:
+                    resp = f"{line.decode()}\r\n"
+                try:
+                    conn.sendall(f"{resp}AE33>".encode())
+                except OSError:
+                    return
+                if close_after_reply:
+                    return
+
+
+def make_ae33(tmp_path, close_after_reply=False, stalls=None):
+    srv = socket.socket()
+    srv.bind(("127.0.0.1", 0))
+    srv.listen()
+    tables = {"Data": 20, "Log": 5}
+    threading.Thread(target=ae33_server, args=(srv, tables, close_after_reply, stalls), daemon=True).start()
+    cfg = {"logs": str(tmp_path / "logs"),
+           "data": str(tmp_path / "data"),
+           "reporting_interval": 10,
+           "staging": {"path": str(tmp_path / "staging")},
+           "ae33": {"type": "AE33",
+                    "serial_number": "AE33-test",
+                    "socket": {"host": "127.0.0.1", "port": srv.getsockname()[1], "timeout": 1, "sleep": 0.1},
+                    "get_config": ["HELLO"],
+                    "set_datetime": False,
+                    "sampling_interval": 1,
+                    "staging_zip": True}}
+    return AE33(name="ae33", config=cfg), srv, tables
+
+
+@pytest.fixture
+def ae33(tmp_path):
+    ae33, srv, _ = make_ae33(tmp_path)
+    yield ae33
+    ae33.close()
+    srv.close()
+
+
+def test_get_new_data_and_log_entries_without_read_ids(ae33, tmp_path):
+    # no .state.json, so neither table has been read before
+    ae33.get_new_data_and_log_entries()
+
+    data = glob.glob(str(tmp_path / "data" / "**" / "*.dat"), recursive=True)
+    logs = glob.glob(str(tmp_path / "data" / "**" / "*.log"), recursive=True)
+    assert len(data) == 1 and len(logs) == 1
+    with open(data[0]) as fh:
+        assert fh.read().splitlines() == [f"Data {i}|x" for i in range(1, 21)]
+    with open(logs[0]) as fh:
+        # the entries fetched are saved after the time they were read
+        assert fh.read().split("|", 1)[1].strip().splitlines() == [f"Log {i}|x" for i in range(1, 6)]
+
+
+def test_reconnect_after_instrument_closed_connection(tmp_path):
+    ae33, srv, tables = make_ae33(tmp_path, close_after_reply=True)
+    try:
+        # each command finds the previous connection closed by the instrument
+        for _ in range(3):
+            assert ae33.tcpip_comm("MAXID Data") == f"{tables['Data']}\n"
+    finally:
+        ae33.close()
+        srv.close()
+
+
+def test_fetch_interrupted_by_timeout(tmp_path):
+    ae33, srv, _ = make_ae33(tmp_path, stalls=[1])
+    try:
+        # the response stalls halfway: nothing is saved, and the records are asked for again next time
+        assert not ae33.get_new_data()
+        assert ae33.get_new_data().splitlines() == [f"Data {i}|x" for i in range(1, 21)]
+        assert not ae33.get_new_data()
+    finally:
+        ae33.close()
+        srv.close()
+
+    data = glob.glob(str(tmp_path / "data" / "**" / "*.dat"), recursive=True)
+    with open(data[0]) as fh:
+        assert fh.read().splitlines() == [f"Data {i}|x" for i in range(1, 21)]
+
+
+def test_fetch_in_chunks(ae33, monkeypatch):
+    monkeypatch.setattr("mkndaq.inst.ae33._FETCH_ROWS", 7)
+    assert ae33.get_new_data().splitlines() == [f"Data {i}|x" for i in range(1, 21)]
+
+
+def test_read_ids_survive_restart(tmp_path):
+    ae33, srv, _ = make_ae33(tmp_path)
+    try:
+        assert ae33.get_new_data().splitlines() == [f"Data {i}|x" for i in range(1, 21)]
+    finally:
+        ae33.close()
+        srv.close()
+
+    # after the restart, only the records added meanwhile are fetched
+    ae33, srv, tables = make_ae33(tmp_path)
+    tables["Data"] = 25
+    try:
+        assert ae33.get_new_data().splitlines() == [f"Data {i}|x" for i in range(21, 26)]
+    finally:
+        ae33.close()
+        srv.close()
+
+
+@pytest.mark.parametrize("state", ['{"Data": 21, "Lo', '', '[21, 6]', '{"Data": "21", "Log": 6}', '{"Data": null, "Log": true}'])
+def test_invalid_state_file_ignored(tmp_path, state):
+    datadir = tmp_path / "data" / "ae33" / "data"
+    datadir.mkdir(parents=True)
+    (datadir / ".state.json").write_text(state)
+
+    ae33, srv, _ = make_ae33(tmp_path)
+    try:
+        # read as if the table was new
+        assert ae33.get_new_data().splitlines() == [f"Data {i}|x" for i in range(1, 21)]
+    finally:
+        ae33.close()
+        srv.close()
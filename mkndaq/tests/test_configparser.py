@@ -1,7 +1,53 @@
+import importlib
+import os
+import warnings
+
+import pytest
+import yaml
+
 from mkndaq.utils import configparser
 
 
 cfg = {'file': 'mkndaq.cfg', 'version': '1.0.0-20210802', 'home': 'c:/users/jkl', 'reporting_interval': 10, 'sftp': {'host': 'sftp.meteoswiss.ch', 'usr': 'gaw_mkn', 'key': '~/.ssh/private-open-ssh-4096-mkn.ppk', 'proxy': {'socks5': None, 'port': 1080}, 'logs': '~/Documents/mkndaq/logs'}, 'logs': '~/Documents/mkndaq/logs', 'data': '~/Documents/mkndaq/data', 'staging': {'path': '~/Documents/mkndaq/staging', 'zip': True}, 'COM2': {'protocol': 'RS232', 'baudrate': 9600, 'bytesize': 8, 'stopbits': 1, 'parity': 'N', 'timeout': 0.1}, 'tei49c': {'type': 'TEI49C', 'id': 49, 'serial_number': 'unknown', 'port': 'COM2', 'get_config': ['mode', 'gas unit', 'range', 'avg time', 'temp comp', 'pres comp', 'format', 'lrec format', 'o3 coef', 'o3 bkg'], 'set_config': ['set mode remote', 'set gas unit ppb', 'set range 1', 'set avg time 3', 'set temp comp on', 'set pres comp on', 'set format 00', 'set lrec format 01 02', 'set save params'], 'get_data': 'lrec', 'data_header': 'time date  flags o3 cellai cellbi bncht lmpt o3lt flowa flowb pres', 'sampling_interval': 1, 'logs': '~/Documents/mkndaq/logs'}, 'tei49i': {'type': 'TEI49I', 'id': 49, 'serial_number': 'unknown', 'socket': {'host': '192.168.1.200', 'port': 9880, 'timeout': 5, 'sleep': 0.5}, 'get_config': ['mode', 'gas unit', 'range', 'avg time', 'temp comp', 'pres comp', 'format', 'lrec format', 'o3 coef', 'o3 bkg'], 'set_config': ['set mode remote', 'set gas unit ppb', 'set range 1', 'set avg time 3', 'set temp comp on', 'set pres comp on', 'set format 00', 'set lrec format 01 02', 'set save params'], 'get_data': 'lr00', 'data_header': 'time date  flags o3 cellai cellbi bncht lmpt o3lt flowa flowb pres', 'sampling_interval': 1, 'logs': '~/Documents/mkndaq/logs'}, 'picarro': {'type': 'G2401', 'serial_number': 'CFKADS2329', 'socket': {'host': '169.254.219.132', 'port': 51020, 'timeout': 1}, 'get_data': ['_Meas_GetBufferFirst', '_Instr_getStatus'], 'ftp': {'host': '127.0.0.1', 'port': 21, 'usr': 'gast', 'pwd': 'gast', 'path': None}, 'sampling_interval': 5, 'aggregation_period': 600, 'reporting_interval': 600}}
 
+
+def test_config_cache(tmp_path):
+    file = tmp_path / "mkndaq.cfg"
+    file.write_text("home: ~\nlogs: ~/logs\n")
+
+    cfg = configparser.config(str(file))
+    cfg['logs'] = None
+    assert configparser.config(str(file))['logs'] == os.path.expanduser("~/logs")
+
+
+def test_config_cache_keeps_latest_version(tmp_path):
+    file = tmp_path / "mkndaq.cfg"
+    file.write_text("home: ~\nlogs: ~/logs\n")
+    configparser.config(str(file))
+    file.write_text("home: ~\nlogs: ~/other/logs\n")
+    os.utime(file, ns=(0, 0))
+
+    assert configparser.config(str(file))['logs'] == os.path.expanduser("~/other/logs")
+    # the entry for the earlier version is replaced, not kept alongside
+    assert len([key for key in configparser._YAML_CACHE if str(file) in str(key)]) == 1
+
+
+def test_libyaml_warning_issued_once(tmp_path, monkeypatch, capsys):
+    file = tmp_path / "mkndaq.cfg"
+    file.write_text("home: ~\nlogs: ~/logs\n")
+    monkeypatch.delattr(yaml, "CSafeLoader", raising=False)
+    try:
+        with pytest.warns(UserWarning, match="libyaml"):
+            importlib.reload(configparser)
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            configparser.config(str(file))
+            configparser.config(str(file))
+        assert "Warning" not in capsys.readouterr().out
+    finally:
+        monkeypatch.undo()
+        importlib.reload(configparser)
+
+
 if __name__ == "__main__":
     tmp = configparser.expanduser_dict_recursive(cfg)
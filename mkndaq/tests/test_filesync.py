@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the file synchronization and staging helpers.
+"""
+
+import os
+import time
+import zipfile
+
+import pytest
+
+# filesync prints in color
+pytest.importorskip("colorama")
+from mkndaq.utils import filesync
+
+# an mtime well outside the 2 s guard of the listing cache
+_OLD = time.time_ns() - 3600 * 1_000_000_000
+
+
+@pytest.fixture(autouse=True)
+def listings(monkeypatch):
+    monkeypatch.setattr(filesync, "_LISTINGS", {})
+
+
+def make_file(path, content="x", mtime_ns=_OLD):
+    path.write_text(content)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+    return path
+
+
+def test_new_files(tmp_path):
+    source = tmp_path / "source"
+    target = tmp_path / "target"
+    source.mkdir()
+    target.mkdir()
+    make_file(source / "new.dat")
+    make_file(source / "copied.dat")
+    make_file(target / "copied.dat")
+    # still being written
+    make_file(source / "recent.dat", mtime_ns=time.time_ns())
+    (source / "folder").mkdir()
+
+    assert filesync._new_files(str(source), str(target), cutoff=time.time() - 60) == ["new.dat"]
+
+
+def test_listing_cached_until_directory_changes(tmp_path):
+    make_file(tmp_path / "a.dat")
+    os.utime(tmp_path, ns=(_OLD, _OLD))
+    assert filesync._listing(str(tmp_path)) == {"a.dat"}
+
+    # a change hidden from the mtime is not seen, as the cached listing is used
+    make_file(tmp_path / "b.dat")
+    os.utime(tmp_path, ns=(_OLD, _OLD))
+    assert filesync._listing(str(tmp_path)) == {"a.dat"}
+
+    # a visible change of the mtime invalidates the cached listing
+    os.utime(tmp_path, ns=(_OLD + 1, _OLD + 1))
+    assert filesync._listing(str(tmp_path)) == {"a.dat", "b.dat"}
+
+
+def test_listing_of_recently_modified_directory_not_cached(tmp_path):
+    make_file(tmp_path / "a.dat")
+    mtime = time.time_ns()
+    os.utime(tmp_path, ns=(mtime, mtime))
+    assert filesync._listing(str(tmp_path)) == {"a.dat"}
+    assert str(tmp_path) not in filesync._LISTINGS
+
+    # changes within the guard may leave the mtime as it is, and are seen nonetheless
+    make_file(tmp_path / "b.dat")
+    os.utime(tmp_path, ns=(mtime, mtime))
+    assert filesync._listing(str(tmp_path)) == {"a.dat", "b.dat"}
+
+
+def test_rsync_copies_new_files_once(tmp_path):
+    source = tmp_path / "source"
+    target = tmp_path / "target"
+    source.mkdir()
+    make_file(source / "a.dat", "a")
+    make_file(source / "b.dat", "b")
+
+    copied = filesync.rsync(str(source), str(target), buckets=None, delay=60)
+    assert sorted(copied) == [str(target / "a.dat"), str(target / "b.dat")]
+    assert (target / "a.dat").read_text() == "a"
+
+    make_file(source / "c.dat", "c")
+    assert filesync.rsync(str(source), str(target), buckets=None, delay=60) == [str(target / "c.dat")]
+    assert filesync.rsync(str(source), str(target), buckets=None, delay=60) == []
+
+
+def test_rsync_daily_buckets(tmp_path):
+    day = time.strftime(os.path.join("%Y", "%m", "%d"))
+    source = tmp_path / "source" / day
+    source.mkdir(parents=True)
+    make_file(source / "a.dat")
+
+    copied = filesync.rsync(str(tmp_path / "source"), str(tmp_path / "target"), buckets="daily", days=1, delay=60)
+    assert copied == [str(tmp_path / "target" / day / "a.dat")]
+
+
+def test_copy_and_stage_zip(tmp_path):
+    # larger than the 1 MiB chunks the source is read in
+    content = os.urandom(3 * 1024 * 1024 + 17)
+    source = tmp_path / "a.dat"
+    source.write_bytes(content)
+    target = tmp_path / "target.dat"
+    stage = tmp_path / "stage"
+    stage.mkdir()
+
+    filesync.copy_and_stage(str(source), str(target), str(stage), zip_files=True)
+
+    assert target.read_bytes() == content
+    assert os.listdir(stage) == ["target.zip"]
+    with zipfile.ZipFile(stage / "target.zip") as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == ["target.dat"]
+        assert zf.getinfo("target.dat").compress_type == zipfile.ZIP_DEFLATED
+        assert zf.read("target.dat") == content
+
+
+def test_copy_and_stage_without_zip(tmp_path):
+    source = make_file(tmp_path / "a.dat", "a")
+    target = tmp_path / "target.dat"
+    stage = tmp_path / "stage"
+    stage.mkdir()
+
+    filesync.copy_and_stage(str(source), str(target), str(stage))
+
+    assert target.read_text() == "a"
+    assert (stage / "target.dat").read_text() == "a"
+
+
+def test_rsync_stages_copied_files(tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    make_file(source / "a.dat", "a")
+
+    filesync.rsync(str(source), str(tmp_path / "target"), buckets=None, delay=60, stage=str(tmp_path / "stage"),
+                   zip_files=True)
+
+    with zipfile.ZipFile(tmp_path / "stage" / "a.zip") as zf:
+        assert zf.read("a.dat") == b"a"
+
+
+def test_link_or_copy_links_on_same_volume(tmp_path):
+    source = make_file(tmp_path / "a.dat", "a")
+    target = tmp_path / "b.dat"
+
+    filesync.link_or_copy(str(source), str(target))
+
+    assert os.path.samefile(source, target)
+
+
+def test_link_or_copy_falls_back_to_copy(tmp_path, monkeypatch):
+    def link(src, dst):
+        # as for source and target on different volumes
+        raise OSError(18, "Invalid cross-device link")
+
+    monkeypatch.setattr(os, "link", link)
+    source = make_file(tmp_path / "a.dat", "a")
+    target = tmp_path / "b.dat"
+
+    filesync.link_or_copy(str(source), str(target))
+
+    assert target.read_text() == "a"
+    assert not os.path.samefile(source, target)
+
+
+def test_link_or_copy_replaces_existing_target(tmp_path):
+    source = make_file(tmp_path / "a.dat", "new")
+    target = make_file(tmp_path / "b.dat", "old")
+
+    filesync.link_or_copy(str(source), str(target))
+
+    assert target.read_text() == "new"
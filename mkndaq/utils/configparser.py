@@ -1,8 +1,20 @@
 # -*- coding: utf-8 -*-
 
 import os
+import warnings
 import yaml
 
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+    # once, when the module is imported, not on every config load
+    warnings.warn("libyaml not available, using pure-Python yaml parser. "
+                  "Reinstall PyYAML with libyaml support for faster parsing.")
+
+# parsed config files, keyed by path, with the (mtime, size) they were parsed at. Only the latest is kept.
+_YAML_CACHE = {}
+
 
 def expanduser_dict_recursive(d):
     try:
@@ -19,6 +31,35 @@ def expanduser_dict_recursive(d):
         return d
 
 
+def _copy_config(value):
+    """
+    Copy the containers of a parsed config. Scalars are immutable and shared, which makes this
+    much cheaper than copy.deepcopy.
+    """
+    if isinstance(value, dict):
+        return {k: _copy_config(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy_config(v) for v in value]
+    return value
+
+
+def load_yaml(file) -> dict:
+    """
+    Parse yaml file. Parsed content is cached and re-used as long as the file is unchanged.
+
+    :param file: full path to yaml file
+    :return: a copy of the parsed content
+    """
+    path = os.path.abspath(file)
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _YAML_CACHE.get(path)
+    if cached is None or cached[0] != stamp:
+        with open(path, "r") as fh:
+            cached = _YAML_CACHE[path] = (stamp, yaml.load(fh, Loader=_Loader))
+    return _copy_config(cached[1])
+
+
 def config(file) -> dict:
     """
     Read config file.
@@ -29,10 +70,7 @@ def config(file) -> dict:
     try:
         print("# Read configuration from %s" % os.path.abspath(file))
         # print("# Read configuration from %s" % file)
-        with open(os.path.abspath(file), "r") as fh:
-        # with open(file, "r") as fh:
-            cfg = yaml.safe_load(fh)
-            fh.close()
+        cfg = load_yaml(file)
 
         # see if HOME is set, otherwise set from config file
         try:
@@ -3,13 +3,107 @@ import os
 import datetime
 import time
 import shutil
-from filecmp import dircmp
 import zipfile
 import colorama
 
 
+# names of files in target directories, keyed by path, with the directory mtime at which they were listed
+_LISTINGS = {}
+
+
 # %%
-def rsync(source: str, target: str, buckets: str = [None, "daily", "monthly"], days: int = 1, delay: int=3600) -> list:
+def _listing(path: str) -> frozenset:
+    """Names of the entries of a directory, cached until the directory's mtime changes (adding or removing an
+    entry updates it).
+
+    Args:
+        path (str): full path to directory
+
+    Returns:
+        frozenset: names of entries
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _LISTINGS.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    names = frozenset(os.listdir(path))
+    # a directory modified within the last few seconds may change again without a visible mtime change
+    # (coarse timestamp resolution), so its listing is not cached yet
+    if time.time_ns() - mtime > 2_000_000_000:
+        _LISTINGS[path] = (mtime, names)
+    return names
+
+
+def _new_files(source: str, target: str, cutoff: float) -> list:
+    """List files in 'source' that are missing in 'target' and were last modified before 'cutoff'.
+
+    The source is read with a single scandir, whose entries carry type and (on Windows) mtime without
+    further system calls. The listing of the target is cached (see _listing).
+
+    Args:
+        source (str): full path to source directory
+        target (str): full path to target directory
+        cutoff (float): epoch seconds
+
+    Returns:
+        list: names of files to copy
+    """
+    existing = _listing(target)
+    with os.scandir(source) as entries:
+        return [entry.name for entry in entries
+                if entry.name not in existing and entry.is_file() and entry.stat().st_mtime < cutoff]
+
+
+def link_or_copy(source: str, target: str) -> None:
+    """Place a file in the staging area without copying its content if possible.
+
+    A hard link is created if source and target are on the same volume. Otherwise (or if the target exists),
+    the file is copied with shutil.copyfile, which uses the fastest copy the platform offers. Only use this for
+    files that are no longer written to, since a hard link shares the content with the original.
+
+    Args:
+        source (str): full path to source file
+        target (str): full path to target file
+    """
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def copy_and_stage(source: str, target: str, stage: str, zip_files: bool = False) -> None:
+    """Copy a file to 'target' and stage it in 'stage', reading the source only once.
+
+    With zip_files, each chunk read from the source is written to the target and to the zip entry in the same pass,
+    so the new file is not read back for compression. Without zip_files, the staged file is a hard link to the target
+    if possible.
+
+    Args:
+        source (str): full path to source file
+        target (str): full path to target file
+        stage (str): staging directory
+        zip_files (bool, optional): Stage as zip archive? Defaults to False.
+    """
+    name = os.path.basename(target)
+    if zip_files:
+        zinfo = zipfile.ZipInfo.from_file(source, name)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        archive = os.path.join(stage, "".join([name[:-4], ".zip"]))
+        with open(source, "rb") as src, open(target, "wb") as tgt, \
+                zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf, zf.open(zinfo, "w") as dst:
+            while True:
+                buf = src.read(1024 * 1024)
+                if not buf:
+                    break
+                tgt.write(buf)
+                dst.write(buf)
+    else:
+        shutil.copyfile(source, target)
+        link_or_copy(target, os.path.join(stage, name))
+
+
+def rsync(source: str, target: str, buckets: str = [None, "daily", "monthly"], days: int = 1, delay: int=3600,
+          stage: str = None, zip_files: bool = False) -> list:
     """Determine files under 'source' that are not present under 'target' and copy them over.
 
     Args:
@@ -18,6 +112,8 @@ def rsync(source: str, target: str, buckets: str = [None, "daily", "monthly"], d
         buckets (str, optional): Are files organized in sub-folders by yyyy, mm, dd (daily) or by yyyy, mm (monthly) or not at all (None)? Defaults to [None, "daily", "monthly"].
         days (int, optional): Number of days to look back. Defaults to 1.
         delay (int, optional): Period (seconds) during which the file must not have been modified. Determines which files are copied. Defaults to 3600.
+        stage (str, optional): If given, copied files are also staged there for transfer (see copy_and_stage). Defaults to None.
+        zip_files (bool, optional): Stage files as zip archives? Defaults to False.
 
     Raises:
         ValueError: raised if buckets are not correctly specified.
@@ -43,35 +139,38 @@ def rsync(source: str, target: str, buckets: str = [None, "daily", "monthly"], d
             raise ValueError(f"'buckets' must be <None|hourly|daily>.")
 
         files_copied = []
-        now = time.time()
+        cutoff = time.time() - delay
+        today = datetime.datetime.now()
+
+        def copy(src_file, tgt_file):
+            if stage:
+                copy_and_stage(src_file, tgt_file, stage, zip_files)
+            else:
+                shutil.copyfile(src_file, tgt_file)
+
+        if stage:
+            os.makedirs(stage, exist_ok=True)
 
         if fmt:
             for day in range(0, days):
-                dte = (datetime.datetime.now() - datetime.timedelta(days=day)).strftime(fmt)
+                dte = (today - datetime.timedelta(days=day)).strftime(fmt)
                 src = os.path.join(source, dte)
                 if os.path.exists(src):
                     tgt = os.path.join(target, dte)
                     os.makedirs(tgt, exist_ok=True)
-                    dcmp = dircmp(src, tgt)
-                    for file in dcmp.left_only:
-                        if os.path.isfile(os.path.join(src, file)):
-                            # print(now)
-                            # print(os.path.getmtime(os.path.join(src, file)))
-                            # print(now - os.path.getmtime(os.path.join(src, file)))
-                            if (now - os.path.getmtime(os.path.join(src, file))) > delay:
-                                shutil.copy(os.path.join(src, file), os.path.join(tgt, file))
-                                files_copied.append(os.path.join(tgt, file))
+                    for file in _new_files(src, tgt, cutoff):
+                        tgt_file = os.path.join(tgt, file)
+                        copy(os.path.join(src, file), tgt_file)
+                        files_copied.append(tgt_file)
                 else:
                     print(f"'{src}' does not exist.")
         else:
             if os.path.exists(source):
                 os.makedirs(target, exist_ok=True)
-                dcmp = dircmp(source, target)
-                for file in dcmp.left_only:
-                    if os.path.isfile(os.path.join(source, file)):
-                        if (now - os.path.getmtime(os.path.join(source, file))) > delay:
-                            shutil.copy(os.path.join(source, file), os.path.join(target, file))
-                            files_copied.append(os.path.join(target, file))
+                for file in _new_files(source, target, cutoff):
+                    tgt_file = os.path.join(target, file)
+                    copy(os.path.join(source, file), tgt_file)
+                    files_copied.append(tgt_file)
             else:
                 print(f"'{source}' does not exist.")
 
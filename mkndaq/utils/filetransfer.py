@@ -7,19 +7,39 @@ Manage files. Currently, sftp transfer to MeteoSwiss is supported.
 """
 #%%
 import os
+import posixpath
+import functools
 import logging
 import re
+import shlex
 from xmlrpc.client import Boolean
 import zipfile
 
 # import pysftp
 import shutil
+import queue
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import sockslib
 import paramiko
 
 import colorama
 
+# path separators are normalized for the remote host, compile patterns once
+_SEP_RE = re.compile(r'(/?\.?\\){1,2}')
+_BACKSLASH_RE = re.compile(r'(\\){1,2}')
+
+# seconds to wait for a remote command. SFTP-only or chrooted accounts may refuse it, or never answer.
+_EXEC_TIMEOUT = 10
+
+
+@functools.lru_cache(maxsize=256)
+def _sanitize(path: str) -> str:
+    """Normalize path separators for the remote host. The same folders recur on every transfer, so results are cached."""
+    return _SEP_RE.sub('/', path)
+
+
 class SFTPClient:
     """
     SFTP based file handling, optionally using SOCKS5 proxy.
@@ -32,6 +52,7 @@ class SFTPClient:
     - setup_remote_folders():
     - put_r(): recursively put files
     - xfer_r(): recursively move files
+    - close(): close the (persistent) connection to the server
     """
 
     _zip = None
@@ -43,6 +64,9 @@ class SFTPClient:
     _sftpkey = None
     _sftpusr = None
     _sftphost = None
+    _workers = 4
+    _ssh = None
+    _ssh_lock = threading.Lock()
 
     @classmethod
     def __init__(cls, config: dict):
@@ -84,6 +108,11 @@ class SFTPClient:
             cls._sftpusr = config['sftp']['usr']
             cls._sftpkey = paramiko.RSAKey.from_private_key_file(\
                 os.path.expanduser(config['sftp']['key']))
+            # number of files transferred in parallel, each over its own SFTP channel. Servers typically allow
+            # 10 sessions per connection (MaxSessions).
+            cls._workers = config['sftp'].get('workers', 4)
+            if cls._workers > 8:
+                print(colorama.Fore.RED + f"Warning: sftp workers={cls._workers} may exceed the server's MaxSessions.")
 
             # configure client proxy if needed
             if config['sftp']['proxy']['socks5']:
@@ -93,7 +122,7 @@ class SFTPClient:
 
             # configure staging
             cls._staging = os.path.expanduser(config['staging']['path'])
-            cls._staging = re.sub(r'(/?\.?\\){1,2}', '/', cls._staging)
+            cls._staging = _sanitize(cls._staging)
             cls._zip = config['staging']['zip']
 
         except Exception as err:
@@ -101,6 +130,35 @@ class SFTPClient:
                 cls._logger.error(err)
             print(err)
 
+    @classmethod
+    def _connect(cls) -> paramiko.SSHClient:
+        """Return the SSH connection to the sftp server, (re-)connecting if there is none or it has dropped.
+
+        The connection is kept open between calls, so the handshake and authentication are not repeated for
+        every transfer. A keepalive prevents idle connections from being dropped by NAT or firewalls.
+
+        Returns:
+            paramiko.SSHClient: connected client
+        """
+        with cls._ssh_lock:
+            transport = cls._ssh.get_transport() if cls._ssh else None
+            if transport is None or not transport.is_active():
+                if cls._ssh:
+                    cls._ssh.close()
+                cls._ssh = paramiko.SSHClient()
+                cls._ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                cls._ssh.connect(hostname=cls._sftphost, username=cls._sftpusr, pkey=cls._sftpkey)
+                cls._ssh.get_transport().set_keepalive(30)
+            return cls._ssh
+
+    @classmethod
+    def close(cls) -> None:
+        """Close the SSH connection to the sftp server, if any."""
+        with cls._ssh_lock:
+            if cls._ssh:
+                cls._ssh.close()
+                cls._ssh = None
+
     @classmethod
     def is_alive(cls) -> bool:
         """Test ssh connection to sftp server.
@@ -109,12 +167,9 @@ class SFTPClient:
             bool: [description]
         """
         try:
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=cls._sftphost, username=cls._sftpusr, pkey=cls._sftpkey)
-
-                with ssh.open_sftp() as sftp:
-                    sftp.close()
+            ssh = cls._connect()
+            with ssh.open_sftp() as sftp:
+                sftp.close()
             return True
         except Exception as err:
             print(err)
@@ -151,7 +206,7 @@ class SFTPClient:
             # pysftp.walktree(localpath, store_files_name, store_dir_name, store_other_file_types)
             # tidy up names
             # dnames = [re.sub(r'(/?\.?\\){1,2}', '/', s) for s in dnames]
-            fnames = [re.sub(r'(/?\.?\\){1,2}', '/', s) for s in fnames]
+            fnames = [_sanitize(s) for s in fnames]
             # onames = [re.sub(r'(/?\.?\\){1,2}', '/', s) for s in onames]
 
             return fnames
@@ -218,22 +273,81 @@ class SFTPClient:
             remotepath (str): relative path to remotefile
         """
         try:
-            remotepath = re.sub(r'(/?\.?\\){1,2}', '/', remotepath)
+            remotepath = _sanitize(remotepath)
             msg = f"{time.strftime('%Y-%m-%d %H:%M:%S')} .put {localpath} > {remotepath}"
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=cls._sftphost, username=cls._sftpusr, pkey=cls._sftpkey)
-                with ssh.open_sftp() as sftp:
-                    sftp.put(localpath=localpath, remotepath=remotepath, confirm=True)
-                    sftp.close()
-                print(msg)
-                cls._logger.info(msg)
+            ssh = cls._connect()
+            with ssh.open_sftp() as sftp:
+                sftp.put(localpath=localpath, remotepath=remotepath, confirm=True)
+                sftp.close()
+            print(msg)
+            cls._logger.info(msg)
 
         except Exception as err:
             if cls._log:
                 cls._logger.error(err)
             print(err)
 
+    @classmethod
+    def _xfer_one(cls, sftp, localpath, localitem, remoteitem, remotename=None) -> bool:
+        """Put a single file to the remote host and remove it locally once its size has been confirmed.
+
+        Args:
+            sftp (paramiko.SFTPClient): open SFTP session
+            localpath (str): top level local directory, used to shorten messages
+            localitem (str): full path to local file
+            remoteitem (str): path to remote file
+            remotename (str, optional): path relative to the session's working directory, used instead of
+                remoteitem for the transfer. Defaults to None.
+
+        Returns:
+            bool: True if the file was transferred and removed locally
+        """
+        res = cls._upload(sftp, localitem, remotename or remoteitem)
+
+        # remove local file if it exists on remote host.
+        try:
+            localsize = os.stat(localitem).st_size
+            if cls._log and cls._logger.isEnabledFor(logging.DEBUG):
+                cls._logger.debug("%s size: %s (local), %s (remote)", remoteitem, localsize, res.st_size)
+            if res.st_size == localsize:
+                os.remove(localitem)
+                msg = "%s .put %s > %s (%s bytes)" % (time.strftime('%Y-%m-%d %H:%M:%S'),
+                                                      localitem.replace(localpath, ''), remoteitem, localsize)
+                print(msg)
+                if cls._log:
+                    cls._logger.info(msg)
+                return True
+            msg = "%s %s size mismatch: %s bytes (local), %s bytes (remote), will try again later." % (
+                time.strftime('%Y-%m-%d %H:%M:%S'), remoteitem, localsize, res.st_size)
+            print(colorama.Fore.RED + msg)
+            if cls._log:
+                cls._logger.error(msg)
+            return False
+        except Exception as err:
+            msg = "%s %s not found on remote host, will try again later." % (time.strftime('%Y-%m-%d %H:%M:%S'), remoteitem)
+            print(colorama.Fore.RED + msg)
+            if cls._log:
+                cls._logger.info(msg)
+                cls._logger.error(err)
+            return False
+
+    @staticmethod
+    def _upload(sftp, localitem, remoteitem):
+        """Upload a file with pipelined writes, i.e., without waiting for the server to acknowledge each request.
+
+        Args:
+            sftp (paramiko.SFTPClient): open SFTP session
+            localitem (str): full path to local file
+            remoteitem (str): path to remote file
+
+        Returns:
+            paramiko.SFTPAttributes: attributes of the remote file, to confirm the transfer
+        """
+        with open(localitem, "rb") as lf, sftp.open(remoteitem, "wb") as rf:
+            rf.set_pipelined(True)
+            shutil.copyfileobj(lf, rf, 1024 * 1024)
+        return sftp.stat(remoteitem)
+
     @classmethod
     def remote_item_exists(cls, remoteitem) -> Boolean:
         """Check on remote server if an item exists. Assume this indicates successful transfer.
@@ -245,14 +359,12 @@ class SFTPClient:
             Boolean: True if item exists, False otherwise.
         """
         try:
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=cls._sftphost, username=cls._sftpusr, pkey=cls._sftpkey)
-                with ssh.open_sftp() as sftp:
-                    if sftp.stat(remoteitem).size > 0:
-                        return True
-                    else:
-                        return False
+            ssh = cls._connect()
+            with ssh.open_sftp() as sftp:
+                if sftp.stat(remoteitem).size > 0:
+                    return True
+                else:
+                    return False
         except Exception as err:
             if cls._log:
                 cls._logger.error(err)
@@ -272,28 +384,61 @@ class SFTPClient:
                 localpath = cls._staging
 
             # sanitize localpath
-            localpath = re.sub(r'(/?\.?\\){1,2}', '/', localpath)
+            localpath = _sanitize(localpath)
 
             if remotepath is None:
                 remotepath = '.'
 
             # sanitize remotepath
-            remotepath = re.sub(r'(/?\.?\\){1,2}', '/', remotepath)
+            remotepath = _sanitize(remotepath)
 
             print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} .setup_remote_folders (source: {localpath}, target: {remotepath})")
 
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=cls._sftphost, username=cls._sftpusr, pkey=cls._sftpkey)
-                with ssh.open_sftp() as sftp:
-                    # determine local directory structure, establish same structure on remote host
-                    for dirpath, dirnames, filenames in os.walk(top=localpath):
-                        dirpath = re.sub(r'(/?\.?\\){1,2}', '/', dirpath).replace(localpath, remotepath)
-                        try:
-                            sftp.mkdir(dirpath, mode=16877)
-                        except OSError:
-                            pass
-                    sftp.close()
+            # determine local directory structure, while the connection is established
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                connecting = executor.submit(cls._connect)
+                dirpaths = [_sanitize(dirpath).replace(localpath, remotepath)
+                            for dirpath, dirnames, filenames in os.walk(top=localpath)]
+                ssh = connecting.result()
+
+            # list every level, parents first, so mkdir creates none implicitly and -m applies to all of them
+            levels = {}
+            for dirpath in dirpaths:
+                parts = dirpath.split('/')
+                for i in range(1, len(parts) + 1):
+                    levels.setdefault('/'.join(parts[:i]))
+            levels = [level for level in levels if level not in ('', '.')]
+
+            # establish same structure on remote host, in a single command if the server provides a shell
+            try:
+                stdin, stdout, stderr = ssh.exec_command(f"mkdir -p -m 755 {' '.join(shlex.quote(d) for d in levels)}",
+                                                         timeout=_EXEC_TIMEOUT)
+                channel = stdout.channel
+                deadline = time.monotonic() + _EXEC_TIMEOUT
+                while not channel.exit_status_ready() and time.monotonic() < deadline:
+                    time.sleep(0.1)
+                # no exit status in time: give up on the shell, the channel is closed either way
+                status = channel.recv_exit_status() if channel.exit_status_ready() else None
+                if status == 0:
+                    channel.close()
+                    return
+                msg = f"remote mkdir failed (exit status: {status}), creating folders via sftp"
+                if status is not None:
+                    msg = f"{msg}: {stderr.read().decode(errors='replace').strip()}"
+                channel.close()
+                if cls._log:
+                    cls._logger.warning(msg)
+            except (paramiko.SSHException, OSError):
+                pass
+
+            # sftp-only server: create folders one by one
+            with ssh.open_sftp() as sftp:
+                for dirpath in levels:
+                    try:
+                        sftp.mkdir(dirpath, mode=16877)
+                    except OSError:
+                        pass
+                sftp.close()
 
         except Exception as err:
             if cls._log:
@@ -304,6 +449,7 @@ class SFTPClient:
     def xfer_r(cls, localpath=None, remotepath=None) -> None:
         """
         Recursively transfer (move) all files from localpath to remotepath. Note: At present, parent elements of remote path must already exist.
+        Files are transferred in parallel over several SFTP channels of one connection (config['sftp']['workers'], default 4).
 
         :param str localpath:
         :param str remotepath:
@@ -322,37 +468,65 @@ class SFTPClient:
 
             print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} .xfer_r (source: {localpath}, target: {cls._sftphost}/{cls._sftpusr}/{remotepath})")
 
+            # walk local directory structure, establish list of files to put to remote location. The connection
+            # is established meanwhile.
+            items = []
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                connecting = executor.submit(cls._connect)
+                for dirpath, dirnames, filenames in os.walk(top=localpath):
+                    remotedir = dirpath.replace(localpath, remotepath)
+                    for filename in filenames:
+                        localitem = os.path.join(dirpath, filename)
+                        remoteitem = _BACKSLASH_RE.sub('/', os.path.join(remotedir, filename))
+                        items.append((localitem, remoteitem))
+                ssh = connecting.result()
+            if not items:
+                return
+
             localitem = None
             remoteitem = None
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=cls._sftphost, username=cls._sftpusr, pkey=cls._sftpkey)
-                with ssh.open_sftp() as sftp:
-                    # walk local directory structure, put file to remote location
-                    for dirpath, dirnames, filenames in os.walk(top=localpath):
-                        for filename in filenames:
-                            localitem = os.path.join(dirpath, filename)
-                            remoteitem = os.path.join(dirpath.replace(localpath, remotepath), filename)
-                            remoteitem = re.sub(r'(\\){1,2}', '/', remoteitem)
-                            msg = "%s .put %s > %s" % (time.strftime('%Y-%m-%d %H:%M:%S'),
-                                                       localitem.replace(localpath, ''), remoteitem)
-                            res = sftp.put(localpath=localitem, remotepath=remoteitem, confirm=True)
-                            print(msg)
-                            cls._logger.info(msg)
-
-                            # remove local file if it exists on remote host.
-                            try:
-                                localsize = os.stat(localitem).st_size
-                                remotesize = res.st_size
-                                print("localitem size: %s, remoteitem size: %s" % (localsize, remotesize))
-                                if remotesize == localsize:
-                                    os.remove(localitem)
-                            except Exception as err:
-                                msg = "%s %s not found on remote host, will try again later." % (time.strftime('%Y-%m-%d %H:%M:%S'), remoteitem)
-                                print(colorama.Fore.RED + msg)
-                                if cls._log:
-                                    cls._logger.info(msg)
-                                    cls._logger.error(err)
+
+            # a pool of SFTP channels on the shared transport. Workers borrow a channel per file and return it.
+            transport = ssh.get_transport()
+            channels = queue.Queue()
+
+            def xfer(item):
+                channel = channels.get()
+                try:
+                    # change into the remote folder once, then put files by name, so the server does not resolve
+                    # the full path for every file
+                    remotedir, remotename = posixpath.split(item[1])
+                    if channel['cwd'] != remotedir:
+                        channel['sftp'].chdir(None)
+                        channel['sftp'].chdir(remotedir or '.')
+                        channel['cwd'] = remotedir
+                    return cls._xfer_one(channel['sftp'], localpath, *item, remotename=remotename)
+                except Exception as err:
+                    msg = "%s %s > %s failed." % (time.strftime('%Y-%m-%d %H:%M:%S'), *item)
+                    print(colorama.Fore.RED + msg)
+                    if cls._log:
+                        cls._logger.info(msg)
+                        cls._logger.error(err)
+                    return False
+                finally:
+                    channels.put(channel)
+
+            transferred = 0
+            try:
+                # opened inside the try, so channels opened before a failing one are closed as well
+                for _ in range(min(cls._workers, len(items))):
+                    channels.put({'sftp': paramiko.SFTPClient.from_transport(transport), 'cwd': None})
+                with ThreadPoolExecutor(max_workers=channels.qsize()) as executor:
+                    for future in as_completed([executor.submit(xfer, item) for item in items]):
+                        transferred += future.result()
+            finally:
+                while not channels.empty():
+                    channels.get()['sftp'].close()
+
+            msg = f"{time.strftime('%Y-%m-%d %H:%M:%S')} .xfer_r {transferred} of {len(items)} files transferred."
+            print(msg)
+            if cls._log:
+                cls._logger.info(msg)
 
         except Exception as err:
             msg = "%s %s > %s failed." % (time.strftime('%Y-%m-%d %H:%M:%S'), localitem, remoteitem)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+
+def set_latency_timer(port: str, latency: int = 1) -> bool:
+    """
+    Lower the latency timer of a USB-serial adapter (e.g., FTDI). The default of 16 ms delays
+    every response of an instrument by up to that amount.
+
+    Only supported on Linux, and requires write access to sysfs. To make the setting permanent
+    and independent of permissions, use a udev rule instead, e.g.
+    ACTION=="add", SUBSYSTEM=="usb-serial", DRIVER=="ftdi_sio", ATTR{latency_timer}="1"
+    On Windows, the latency timer is set in the advanced port settings of the device manager.
+
+    :param port: serial device, e.g. /dev/ttyUSB0 or a symlink to it
+    :param latency: latency timer in ms
+    :return: True if the latency timer was set, False otherwise
+    """
+    if not sys.platform.startswith('linux'):
+        return False
+    device = os.path.basename(os.path.realpath(port))
+    try:
+        with open(f"/sys/bus/usb-serial/devices/{device}/latency_timer", "w") as fh:
+            fh.write(str(latency))
+        return True
+    except OSError:
+        return False
+
+
+if __name__ == "__main__":
+    pass
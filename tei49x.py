@@ -1,8 +1,6 @@
 # %%
 import os
 import argparse
-from mkndaq.inst.tei49c import TEI49C
-from mkndaq.inst.tei49i import TEI49I
 
 
 def main():
@@ -70,10 +68,13 @@ def main():
                             'staging_zip': True,
                             }}
         # print(cfg)
+        # import the instrument class only now, so that --help does not pay for pyserial etc.
         if args.type=='tei49i':
+            from mkndaq.inst.tei49i import TEI49I
             tei49i = TEI49I(name='tei49i', config=cfg, serial_com=serial_com)
             tei49i.get_all_lrec()
         elif args.type=='tei49c':
+            from mkndaq.inst.tei49c import TEI49C
             tei49c = TEI49C(name='tei49c', config=cfg)
             tei49c.get_all_rec()
         else: